@@ -13,6 +13,7 @@ import gym
 from snake_gym import SnakeEnv
 import wandb
 from tf2_common import make_main_model
+from returns import discounted_returns
 
 @tf.function
 def calc_entropy(logits):
@@ -171,12 +172,12 @@ def main():
 
         _, _, R = model(state)
 
-        discounted_rewards = []
-        for _, _, r, _, d, _ in reversed(sarsdv):
-            R = r + model.gamma * R * (1-d)
-            discounted_rewards.append(R)
-
-        discounted_rewards = np.concatenate(np.array(list(reversed(discounted_rewards))))
+        discounted_rewards = discounted_returns(
+            np.stack([r for _, _, r, _, _, _ in sarsdv]),
+            np.stack([d for _, _, _, _, d, _ in sarsdv]),
+            np.array(R),
+            model.gamma,
+        ).reshape(-1, 1)
 
         states = _a(sarsdv, 0)
         values = _a(sarsdv, -1)
@@ -16,6 +16,7 @@ import gym
 from snake_gym import SnakeEnv
 import wandb
 from tf2_common import make_main_model, make_eights_model
+from returns import discounted_returns
 
 def _a(l, idx):
     return np.concatenate([m[idx] for m in l])
@@ -124,10 +125,12 @@ def run_train_step(state, rew, pbar, envs, model, num_actions, batch_size, steps
 
     _, _, R = model(state)
 
-    discounted_rewards = []
-    for _, _, r, _, d, _ in reversed(sarsdv):
-        R = r + model.gamma * R * (1-d)
-        discounted_rewards.append(R)
+    discounted_rewards = discounted_returns(
+        np.stack([r for _, _, r, _, _, _ in sarsdv]),
+        np.stack([d for _, _, _, _, d, _ in sarsdv]),
+        np.array(R),
+        model.gamma,
+    )
 
     tots = len(sarsdv)
 
@@ -139,7 +142,7 @@ def run_train_step(state, rew, pbar, envs, model, num_actions, batch_size, steps
     # values = _a(sarsdv, -1)[idxs]
     # actions = _a(sarsdv, 1)[idxs]
 
-    discounted_rewards = np.concatenate(np.array(list(reversed(discounted_rewards))))
+    discounted_rewards = discounted_rewards.reshape(-1, 1)
 
     states = _a(sarsdv, 0)
     values = _a(sarsdv, -1)
@@ -0,0 +1,164 @@
+import json
+import time
+import itertools
+import numpy as np
+import argh
+from placement import plan_layout
+
+default_config_path = "autotune.json"
+
+
+def load_config(path=default_config_path, env_name="snake"):
+    """the settings autotune picked, see tune, for a run on env_name"""
+    with open(path) as f:
+        cfg = json.load(f)
+    if cfg.get("env_name", "snake") != env_name:
+        raise ValueError(f"{path} was tuned for {cfg.get('env_name', 'snake')}, not {env_name}")
+    return cfg
+
+
+def snake_env_factory(gs=20, main_gs=22):
+    import gym
+    import snake_gym
+
+    return lambda: gym.make("snakenv-v0", gs=gs, main_gs=main_gs, num_fruits=1, obs_mode="tiles")
+
+
+def make_manager(env_factory, num_envs, num_workers, **kwargs):
+    from common import EnvManager, ProcessEnvManager
+
+    layout = plan_layout(num_workers)
+    if num_workers == 0:
+        return EnvManager(env_factory, num_envs, num_threads=layout.learner_threads, **kwargs)
+    return ProcessEnvManager(env_factory, num_envs, num_workers=num_workers, layout=layout, **kwargs)
+
+
+def model_policy(model, device, recurrent_size):
+    """actions sampled from a VisualAgentPPO, the way the trainers run it"""
+    import torch
+
+    def policy(state):
+        with torch.no_grad():
+            hxs = torch.zeros((len(state), recurrent_size), device=device)
+            dist, _, _ = model(torch.FloatTensor(state).to(device), hxs)
+        return dist.sample().tolist()
+
+    return policy
+
+
+def measure_env_steps(env_factory, num_envs, num_workers, policy, seconds=3.0, **kwargs):
+    """env steps per second of policy + apply_actions on all envs"""
+    m = make_manager(env_factory, num_envs, num_workers, **kwargs)
+    try:
+        for _ in range(3):
+            m.apply_actions(policy(m.state))
+        steps = 0
+        start = time.perf_counter()
+        while time.perf_counter() - start < seconds:
+            m.apply_actions(policy(m.state))
+            steps += num_envs
+        return steps / (time.perf_counter() - start)
+    finally:
+        if hasattr(m, "close"):
+            m.close()
+
+
+def measure_learner(model, obs_shape, num_actions, num_samples, mini_batch_size, recurrent_size, ppo_epochs=4):
+    """samples per second through one ppo_update over a rollout of num_samples"""
+    import torch
+
+    states = torch.randint(0, 256, (num_samples,) + tuple(obs_shape)).float()
+    actions = torch.randint(0, num_actions, (num_samples, 1))
+    log_probs = torch.full((num_samples, 1), -np.log(num_actions))
+    returns = torch.randn(num_samples, 1)
+    advantages = torch.randn(num_samples, 1)
+    r_states = torch.zeros(num_samples, recurrent_size)
+    start = time.perf_counter()
+    model.ppo_update(ppo_epochs, mini_batch_size, states, actions, log_probs, returns, advantages, r_states)
+    return num_samples / (time.perf_counter() - start)
+
+
+def tune(
+    device="cuda",
+    seconds=3.0,
+    out=default_config_path,
+    workers=None,
+    envs=(16, 32, 64, 128),
+    steps=(8, 16, 32),
+    mini_batches=(256, 512, 1024),
+    recurrent_size=256,
+):
+    """
+    Short search for the settings of pytorch_single_thread_train (snake) on
+    this machine. Env throughput is measured for every env and worker count
+    with the model acting, learner throughput for every rollout length and
+    minibatch size on the best env setup per env count. The pick maximises
+    the end to end rate of a rollout followed by its update,
+    1 / (1 / env steps/s + 1 / learner samples/s), and is written to out.
+    """
+    from pytorch_common import VisualAgentPPO
+
+    cpus = len(plan_layout().learner)
+    if workers is None:
+        workers = sorted({0, 1, 2, 4, cpus // 2, cpus} & set(range(cpus + 1)))
+    workers, envs, steps, mini_batches = [[int(x) for x in v] for v in (workers, envs, steps, mini_batches)]
+    env_factory = snake_env_factory()
+    probe = make_manager(env_factory, 1, 0, pytorch=True, batch_render=True)
+    obs_shape = probe.state.shape[1:]
+
+    def new_model():
+        return VisualAgentPPO(
+            (1, obs_shape[-1], obs_shape[-1]), 4, device=device, recurrent=recurrent_size, smaller=True
+        ).to(device)
+
+    policy = model_policy(new_model(), device, recurrent_size)
+    env_rates = {}
+    for num_workers, num_envs in itertools.product(workers, envs):
+        if num_workers > num_envs:
+            continue
+        rate = measure_env_steps(
+            env_factory, num_envs, num_workers, policy, seconds, pytorch=True, batch_render=True
+        )
+        env_rates[num_envs, num_workers] = rate
+        print(f"envs {num_envs:4d} workers {num_workers:3d}: {rate:9.1f} env steps/s")
+
+    best = None
+    for num_envs in envs:
+        candidates = [(r, w) for (n, w), r in env_rates.items() if n == num_envs]
+        if not candidates:
+            continue
+        env_rate, num_workers = max(candidates)
+        for num_steps, mini_batch_size in itertools.product(steps, mini_batches):
+            num_samples = num_envs * num_steps
+            if mini_batch_size > num_samples:
+                continue
+            learner_rate = measure_learner(
+                new_model(), obs_shape, 4, num_samples, mini_batch_size, recurrent_size
+            )
+            rate = 1 / (1 / env_rate + 1 / learner_rate)
+            print(
+                f"envs {num_envs:4d} steps {num_steps:3d} minibatch {mini_batch_size:5d}: "
+                f"{learner_rate:9.1f} samples/s, {rate:9.1f} end to end"
+            )
+            if best is None or rate > best["end_to_end_per_sec"]:
+                best = {
+                    "env_name": "snake",
+                    "num_envs": num_envs,
+                    "num_workers": num_workers,
+                    "num_steps": num_steps,
+                    "mini_batch_size": mini_batch_size,
+                    "env_steps_per_sec": env_rate,
+                    "learner_samples_per_sec": learner_rate,
+                    "end_to_end_per_sec": rate,
+                    "cpus": cpus,
+                    "device": device,
+                }
+
+    with open(out, "w") as f:
+        json.dump(best, f, indent=2)
+    print(f"wrote {best} to {out}")
+    return best
+
+
+if __name__ == "__main__":
+    argh.dispatch_command(tune)
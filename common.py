@@ -1,7 +1,12 @@
+import os
+import queue
+import threading
 import numpy as np
 import time
+import cv2
 import torch
 from dataclasses import dataclass
+from returns import gae
 
 from concurrent.futures import ThreadPoolExecutor
 
@@ -18,7 +23,123 @@ def permute_axes_and_prep_image(im, pytorch=False):
             return np.transpose(im, (2, 0, 1))
 
 
+class FrameMailbox:
+    """single slot holding the latest frame, put replaces whatever is there"""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._frame = None
+        self._version = 0
+
+    def put(self, frame):
+        frame = np.array(frame)
+        with self._cond:
+            self._frame = frame
+            self._version += 1
+            self._cond.notify()
+
+    def get(self, version, timeout=None):
+        """the latest frame and its version once it is newer than version"""
+        with self._cond:
+            self._cond.wait_for(lambda: self._version > version, timeout)
+            return self._frame, self._version
+
+
+class Visualizer:
+    """
+    Shows the latest observations of the watched envs in a cv2 window from
+    a background thread, at most fps times a second. The stepping loop only
+    pays for the copy into the mailbox. Observations are [N, C, H, W]
+    (pytorch) or [N, H, W, C]. Grey and RGB frames are shown as they are;
+    of a frame stack only the last frame_channels channels (one frame) are
+    shown, and grid planes show head, body and fruit as RGB. frame_channels
+    is guessed when not given: grid observations when C is a multiple of
+    snake.GRID_CHANNELS, grey frames otherwise.
+    """
+
+    def __init__(self, pytorch=False, fps=30, height=320, name="EnvManager", frame_channels=None):
+        self.pytorch = pytorch
+        self.frame_channels = frame_channels
+        self.fps = fps
+        self.height = height
+        self.name = name
+        self.mailbox = FrameMailbox()
+        self._stop = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def put(self, frames):
+        self.mailbox.put(frames)
+
+    def _image(self, frames):
+        if self.pytorch:
+            frames = frames.transpose(0, 2, 3, 1)
+        if frames.dtype != np.uint8:
+            frames = np.clip(frames, 0, 255).astype(np.uint8)
+        frames = self._displayable(frames)
+        im = np.concatenate(list(frames), 1)
+        im = cv2.cvtColor(im, cv2.COLOR_GRAY2BGR if im.shape[-1] == 1 else cv2.COLOR_RGB2BGR)
+        w = im.shape[1] * self.height // im.shape[0]
+        return cv2.resize(im, (w, self.height), interpolation=cv2.INTER_NEAREST)
+
+    def _displayable(self, frames):
+        # [N, H, W, C] down to 1 or 3 channels
+        c = frames.shape[-1]
+        if c in (1, 3):
+            return frames
+        k = self.frame_channels
+        if k is None:
+            from snake import GRID_CHANNELS
+
+            k = GRID_CHANNELS if c % GRID_CHANNELS == 0 else 1
+        frames = frames[..., c - k:]
+        return frames[..., :3] if k > 3 else frames
+
+    def _run(self):
+        version = 0
+        while not self._stop:
+            start = time.time()
+            frames, new_version = self.mailbox.get(version, timeout=0.5)
+            if new_version == version:
+                continue
+            version = new_version
+            im = self._image(frames)
+            try:
+                cv2.imshow(self.name, im)
+                cv2.waitKey(1)
+            except cv2.error as e:
+                print(f"visualizer stopped, can't show frames: {e}")
+                return
+            time.sleep(max(0.0, 1 / self.fps - (time.time() - start)))
+
+    def close(self):
+        self._stop = True
+        self._thread.join()
+
+
 class EnvManager:
+    """
+    Steps num_envs gym envs from a thread pool. Observations, rewards and
+    dones are written into buffers allocated once, so the arrays
+    apply_actions / step_wait return belong to the manager and are only
+    valid until the next step; copy whatever has to outlive it. Each env
+    repeats its action skip times, summing the rewards and stopping early
+    when the episode ends. Finished envs are reset straight away, the last
+    observation of their episode is in info["terminal_state"].
+
+    Besides stepping all envs together it can hand out partial batches, like
+    envpool with batch_size < num_envs, so slow envs don't hold up the rest:
+
+        m.async_reset()
+        while True:
+            env_ids, obs, rewards, dones, infos = m.recv()
+            m.send(policy(obs), env_ids)
+
+    recv returns the first batch_size envs to finish their step, the others
+    keep stepping in the background. Don't mix this with apply_actions
+    while steps are in flight.
+    """
+
     def __init__(
         self,
         env_factory,
@@ -29,59 +150,445 @@ class EnvManager:
         test_delay=0.01,
         reward_mult=1.0,
         skip=1,
+        batch_render=False,
+        permute=True,
+        batch_size=None,
+        num_threads=None,
     ):
         self.envs = [env_factory() for _ in range(num_envs)]
         self.test_env = env_factory()
-        self._p = lambda im: permute_axes_and_prep_image(im, pytorch)
+        self.batch_size = num_envs if batch_size is None else batch_size
+        self._ready = None
+        # permute=False takes observations as they come, for envs that
+        # already produce the layout the model wants (SnakeEnv(layout='chw'))
+        self._p = (lambda im: permute_axes_and_prep_image(im, pytorch)) if permute else (lambda im: im)
+        self.pytorch = pytorch
         self.reward_mult = reward_mult
-        self.state = np.stack([self._p(env.reset()) for env in self.envs])
+        # batch_render needs snake envs made with SnakeEnv(obs_mode='tiles'),
+        # their boards are then drawn together in one go
+        self.renderer = None
+        if batch_render:
+            from snake_render import TileRenderer
+
+            self.renderer = TileRenderer.for_env(self.envs[0].unwrapped.env)
+        obs = [env.reset() for env in self.envs]
+        self.state = self._stack_obs(obs)
+        # the next observations are written into _next, which then swaps
+        # places with state
+        self._next = np.zeros_like(self.state)
+        self.rewards = np.zeros((num_envs, 1))
+        self.dones = np.zeros((num_envs, 1), dtype=bool)
+        if self.renderer is not None:
+            self._tiles = np.stack([o[0] for o in obs])
+            self._rotations = np.stack([o[1] for o in obs])
         self.num_viz_train = num_viz_train
+        # the first num_viz_train envs are shown from a Visualizer thread
+        self.visualizer = Visualizer(pytorch) if num_viz_train else None
         self.skip = skip
-        self.ex = ThreadPoolExecutor(num_envs)
+        # one thread per env unless num_threads caps it
+        self.ex = ThreadPoolExecutor(num_threads or num_envs)
+        self._pending = None
         self.viz()
 
+    def _stack_obs(self, obs):
+        if self.renderer is None:
+            return np.stack([self._p(o) for o in obs])
+        tiles, rotations = zip(*obs)
+        frames = self.renderer.render(np.stack(tiles), np.stack(rotations))
+        return np.expand_dims(frames, 1 if self.pytorch else -1)
+
+    def _put_obs(self, i, obs):
+        if self.renderer is None:
+            self._next[i] = self._p(obs)
+        else:
+            self._tiles[i], self._rotations[i] = obs
+
     def viz(self):
-        for env in self.envs[: self.num_viz_train]:
-            env.render()
-            # time.sleep(0.1)
+        if self.visualizer is not None:
+            self.visualizer.put(self.state[: self.num_viz_train])
+
+    def use_buffers(self, state, next_state, rewards, dones):
+        """
+        step into these arrays (e.g. views of shared memory) from now on
+        instead of the manager's own, state takes over the current state
+        """
+        if state is not self.state:
+            state[:] = self.state
+        self.state, self._next, self.rewards, self.dones = state, next_state, rewards, dones
+
+    def _step_env(self, i, action):
+        env = self.envs[i]
+        total = 0.0
+        for _ in range(self.skip):
+            s, r, done, info = env.step(action)
+            total += r
+            if done:
+                break
+        if done:
+            info["terminal_state"] = self._stack_obs([s])[0]
+            s = env.reset()
+        self._put_obs(i, s)
+        self.rewards[i] = total * self.reward_mult
+        self.dones[i] = done
+        return info
+
+    def step_async(self, actions):
+        """start stepping every env, step_wait collects what apply_actions returns"""
+        self._pending = [self.ex.submit(self._step_env, i, a) for i, a in enumerate(actions)]
+
+    def step_wait(self):
+        info_dicts = tuple(f.result() for f in self._pending)
+        self._pending = None
+        if self.renderer is not None:
+            n, h, w = len(self.envs), *self.renderer.shape
+            self.renderer.render(self._tiles, self._rotations, out=self._next.reshape(n, h, w))
+        self.viz()
+
+        out_state = self.state
+        self.state, self._next = self._next, self.state
+
+        return out_state, self.rewards, self.dones, info_dicts
 
     def apply_actions(self, actions):
-        for i in range(self.skip):
-            # next_state, rewards, dones_list, info_dicts = zip(
-            #     *[env.step(a) for env, a in zip(self.envs, actions)]
-            # )
-            next_state, rewards, dones_list, info_dicts = zip(
-                *(self.ex.map(lambda x: x[0].step(x[1]), zip(self.envs, actions)))
+        self.step_async(actions)
+        return self.step_wait()
+
+    def async_reset(self):
+        """start partial batch stepping, every env is ready with its current observation"""
+        self._ready = queue.SimpleQueue()
+        if self.renderer is None:
+            self._next[:] = self.state
+        self.rewards[:] = 0
+        self.dones[:] = False
+        for i in range(len(self.envs)):
+            self._ready.put((i, {}))
+
+    def _step_ready(self, i, action):
+        try:
+            info = self._step_env(i, action)
+        except Exception as e:
+            info = e
+        self._ready.put((i, info))
+
+    def send(self, actions, env_ids):
+        """step the envs in env_ids, which must all have come out of recv"""
+        for i, a in zip(env_ids, actions):
+            self.ex.submit(self._step_ready, i, a)
+
+    def recv(self):
+        """
+        (env_ids, obs, rewards, dones, info_dicts) of the next batch_size envs
+        to finish a step, obs being the observation to act on next
+        """
+        ready = [self._ready.get() for _ in range(self.batch_size)]
+        for _, info in ready:
+            if isinstance(info, Exception):
+                raise info
+        env_ids = np.array([i for i, _ in ready])
+        if self.renderer is None:
+            obs = self._next[env_ids]
+        else:
+            frames = self.renderer.render(self._tiles[env_ids], self._rotations[env_ids])
+            obs = np.expand_dims(frames, 1 if self.pytorch else -1)
+        return env_ids, obs, self.rewards[env_ids], self.dones[env_ids], tuple(info for _, info in ready)
+
+
+def _env_worker(conn, env_factory, envs, kwargs, cpus=None, threads=1):
+    # owns an EnvManager over the slice envs of all envs and steps it on
+    # request. Its buffers are its rows of the shared blocks, so
+    # observations, rewards and dones are written there directly. Every step
+    # command names which of the two state blocks to write
+    from multiprocessing import shared_memory
+    from placement import configure_process
+
+    configure_process(cpus, threads)
+    m = EnvManager(env_factory, envs.stop - envs.start, num_threads=threads, **kwargs)
+    conn.send((m.state.shape[1:], m.state.dtype.str))
+    blocks = [shared_memory.SharedMemory(name=name) for name in conn.recv()]
+    *states, actions, rewards, dones = [
+        np.ndarray(shape, dtype, buffer=b.buf)[envs] for b, (shape, dtype) in zip(blocks, conn.recv())
+    ]
+    m.use_buffers(states[0], states[1], rewards, dones)
+    conn.send(None)
+    while True:
+        cmd = conn.recv()
+        if cmd is None:
+            break
+        # normally a no-op, the manager swaps its blocks after every step too
+        m.use_buffers(states[1 - cmd], states[cmd], rewards, dones)
+        _, _, _, info_dicts = m.apply_actions(actions.tolist())
+        conn.send(info_dicts)
+    del states, actions, rewards, dones
+    for b in blocks:
+        b.close()
+    conn.close()
+
+
+class ProcessEnvManager:
+    """
+    EnvManager with the envs split over num_workers processes, so envs
+    written in pure python step on all cores. Every worker runs an
+    EnvManager over its slice and writes into shared memory, alternating
+    between two state blocks. state is a view of the current block and only
+    the step command and the info dicts go through the pipes. apply_actions
+    returns the same as EnvManager.apply_actions, with the same rule that
+    the arrays are only valid until the next step. close() shuts the
+    workers down.
+
+    layout, a placement.Layout with a cpu set per worker, pins the workers
+    and caps their env stepping and torch/OpenCV/BLAS threads; without one
+    they are capped at one thread each and left where the OS puts them.
+    """
+
+    def __init__(
+        self,
+        env_factory,
+        num_envs,
+        num_workers=os.cpu_count(),
+        pytorch=False,
+        num_viz_train=0,
+        viz_test=False,
+        test_delay=0.01,
+        reward_mult=1.0,
+        skip=1,
+        batch_render=False,
+        permute=True,
+        layout=None,
+    ):
+        import multiprocessing as mp
+        from multiprocessing import resource_tracker, shared_memory
+
+        # workers must share the parent's tracker, one of their own would
+        # unlink the blocks when the worker exits
+        resource_tracker.ensure_running()
+        self.num_envs = num_envs
+        self.test_env = env_factory()
+        num_workers = min(num_workers, num_envs)
+        bounds = np.linspace(0, num_envs, num_workers + 1).astype(int)
+        self.slices = [slice(a, b) for a, b in zip(bounds[:-1], bounds[1:])]
+
+        self.conns, self.procs = [], []
+        for w, sl in enumerate(self.slices):
+            kwargs = dict(
+                pytorch=pytorch,
+                num_viz_train=0,
+                reward_mult=reward_mult,
+                skip=skip,
+                batch_render=batch_render,
+                permute=permute,
             )
+            parent, child = mp.Pipe()
+            cpus, threads = (None, 1) if layout is None else (layout.workers[w], layout.worker_threads)
+            p = mp.Process(
+                target=_env_worker, args=(child, env_factory, sl, kwargs, cpus, threads), daemon=True
+            )
+            p.start()
+            child.close()
+            self.conns.append(parent)
+            self.procs.append(p)
+
+        obs_shape, obs_dtype = [c.recv() for c in self.conns][0]
+        layouts = [
+            ((num_envs,) + tuple(obs_shape), np.dtype(obs_dtype)),
+            ((num_envs,) + tuple(obs_shape), np.dtype(obs_dtype)),
+            ((num_envs,), np.int64),
+            ((num_envs, 1), np.float64),
+            ((num_envs, 1), bool),
+        ]
+        self._blocks = [
+            shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize))
+            for shape, dtype in layouts
+        ]
+        *self._states, self.actions, self.rewards, self.dones = [
+            np.ndarray(shape, dtype, buffer=b.buf) for b, (shape, dtype) in zip(self._blocks, layouts)
+        ]
+        self._current = 0
+        self.state = self._states[0]
+        self.num_viz_train = num_viz_train
+        self.visualizer = Visualizer(pytorch) if num_viz_train else None
+        self.viz()
+        for c in self.conns:
+            c.send([b.name for b in self._blocks])
+            c.send(layouts)
+        for c in self.conns:
+            c.recv()
 
-            self.viz()
-        next_state = np.stack([self._p(s) for s in next_state])
-        rewards = np.expand_dims(np.stack(rewards), -1) * self.reward_mult
-        dones = np.expand_dims(np.stack(dones_list), -1)
+    def step_async(self, actions):
+        self.actions[:] = actions
+        for c in self.conns:
+            c.send(1 - self._current)
 
+    def step_wait(self):
+        info_dicts = ()
+        for c in self.conns:
+            info_dicts += tuple(c.recv())
         out_state = self.state
-        self.state = next_state
-        for i, env in enumerate(self.envs):
-            if dones_list[i]:
-                self.state[i] = self._p(env.reset())
+        self._current = 1 - self._current
+        self.state = self._states[self._current]
+        self.viz()
+        return out_state, self.rewards, self.dones, info_dicts
+
+    def viz(self):
+        if self.visualizer is not None:
+            self.visualizer.put(self.state[: self.num_viz_train])
+
+    def apply_actions(self, actions):
+        self.step_async(actions)
+        return self.step_wait()
+
+    def close(self):
+        if self.visualizer is not None:
+            self.visualizer.close()
+        for c, p in zip(self.conns, self.procs):
+            c.send(None)
+            p.join()
+            c.close()
+        self.state = self._states = self.actions = self.rewards = self.dones = None
+        for b in self._blocks:
+            b.close()
+            b.unlink()
+        self._blocks = []
 
-        return out_state, rewards, dones, info_dicts
+
+def make_env_groups(manager, env_factory, num_envs, double_buffer=False, **kwargs):
+    """
+    one manager over all envs, or with double_buffer two managers over
+    half of them each for pipelined_steps
+    """
+    if not double_buffer:
+        return [manager(env_factory, num_envs, **kwargs)]
+    half = num_envs // 2
+    # only the first group gets the visualised envs
+    viz = kwargs.pop("num_viz_train", 0)
+    return [
+        manager(env_factory, half, num_viz_train=viz, **kwargs),
+        manager(env_factory, num_envs - half, **kwargs),
+    ]
+
+
+def pipelined_steps(groups, policy, num_steps):
+    """
+    Steps every group (anything with state, step_async and step_wait) num_steps
+    times, calling policy on one group while the others are still stepping.
+    policy(g, state) returns (actions, extra) for group g. Yields
+    (step, g, extra, result) once the step taken with those actions is done,
+    result being what apply_actions returns, in step then group order. The
+    policy of a group is only called again after its result has been
+    consumed, so done handling (e.g. resetting recurrent states) in the loop
+    body is seen by the next policy call. With a single group this is
+    apply_actions in a loop.
+    """
+    pending = [None] * len(groups)
+    for step in range(num_steps):
+        for g, m in enumerate(groups):
+            if step > 0:
+                yield step - 1, g, pending[g], m.step_wait()
+            actions, pending[g] = policy(g, m.state)
+            m.step_async(actions)
+    for g, m in enumerate(groups):
+        yield num_steps - 1, g, pending[g], m.step_wait()
 
 
 def compute_gae(next_value, rewards, dones, values, gamma=0.999, lmbda=0.98):
-    masks = [1 - d for d in dones]
-    values = values + [next_value]
-    gae = 0
-    returns = []
-    for step in reversed(range(len(rewards))):
-        delta = (
-            rewards[step]
-            + gamma * values[step + 1].detach().numpy() * masks[step]
-            - values[step].detach().numpy()
-        )
-        gae = delta + gamma * lmbda * masks[step] * gae
-        returns.append(gae + values[step].detach().numpy())
-    return list(reversed(returns))
+    """per step lists in, per step returns out, see returns.gae"""
+    _, ret = gae(
+        np.stack(rewards),
+        torch.stack(values).detach().numpy(),
+        np.stack(dones),
+        next_value.detach().numpy(),
+        gamma,
+        lmbda,
+    )
+    return list(ret)
+
+
+def default_device():
+    return torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+class PinnedStaging:
+    """
+    Page-locked host buffers for DeviceRollout uploads, one per rollout
+    tensor and kept across updates, so an upload is a copy into memory that
+    is already pinned rather than a fresh pinned allocation
+    """
+
+    def __init__(self):
+        self.buffers = {}
+        # recorded after the last uploads from the buffers
+        self.done = None
+
+    def stage(self, slot, tensor):
+        if self.done is not None:
+            self.done.synchronize()
+            self.done = None
+        buf = self.buffers.get(slot)
+        if buf is None or buf.shape != tensor.shape or buf.dtype != tensor.dtype:
+            buf = self.buffers[slot] = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True)
+        buf.copy_(tensor)
+        return buf
+
+
+class DeviceRollout:
+    """
+    Rollout tensors (first dim is samples) copied to device once and served
+    as shuffled minibatches, a new permutation every epoch. On cuda the host
+    tensors go through staging, a PinnedStaging the caller keeps between
+    updates, and are uploaded on a side stream that is only waited for when
+    the first minibatch is drawn. uint8 tensors (frames) stay uint8 for the
+    upload and on the device, their minibatches come out as float. None
+    entries stay None.
+
+        rollout = DeviceRollout([states, actions, returns], device)
+        for _ in range(ppo_epochs):
+            for state, action, return_ in rollout.minibatches(256):
+                ...
+    """
+
+    def __init__(self, tensors, device=None, staging=None):
+        self.device = default_device() if device is None else torch.device(device)
+        self.size = next(t for t in tensors if t is not None).size(0)
+        self._stream = None
+        if self.device.type != "cuda":
+            self.tensors = [None if t is None else t.to(self.device) for t in tensors]
+            return
+
+        staging = PinnedStaging() if staging is None else staging
+        self._stream = torch.cuda.Stream(self.device)
+        # tensors already on the gpu may still be being written
+        self._stream.wait_stream(torch.cuda.current_stream(self.device))
+        self.tensors = []
+        for i, t in enumerate(tensors):
+            if t is not None and t.device.type == "cpu" and not t.is_pinned():
+                # the upload of the previous tensor runs meanwhile
+                t = staging.stage(i, t)
+            with torch.cuda.stream(self._stream):
+                self.tensors.append(None if t is None else t.to(self.device, non_blocking=True))
+        staging.done = torch.cuda.Event()
+        staging.done.record(self._stream)
+
+    def _wait(self):
+        if self._stream is None:
+            return
+        current = torch.cuda.current_stream(self.device)
+        current.wait_stream(self._stream)
+        for t in self.tensors:
+            if t is not None:
+                t.record_stream(current)
+        self._stream = None
+
+    def minibatches(self, mini_batch_size, drop_last=False):
+        self._wait()
+        perm = torch.randperm(self.size, device=self.device)
+        end = self.size - self.size % mini_batch_size if drop_last else self.size
+        for i in range(0, end, mini_batch_size):
+            idx = perm[i : i + mini_batch_size]
+            yield [None if t is None else _gather(t, idx) for t in self.tensors]
+
+
+def _gather(tensor, idx):
+    batch = tensor.index_select(0, idx)
+    return batch.float() if batch.dtype == torch.uint8 else batch
 
 
 class RolloutStorage:
@@ -89,8 +596,9 @@ class RolloutStorage:
     fixed sized storage for generating rollouts
     """
 
-    def __init__(self, num_steps, num_envs, obs_shape, num_actions, recurrent_size):
-        self.obs = torch.zeros(num_steps + 1, num_envs, *obs_shape)
+    def __init__(self, num_steps, num_envs, obs_shape, num_actions, recurrent_size, obs_dtype=torch.float32):
+        # obs_dtype=torch.uint8 keeps 0-255 frames as bytes up to the device
+        self.obs = torch.zeros(num_steps + 1, num_envs, *obs_shape, dtype=obs_dtype)
         self.recurrent_states = torch.zeros(num_steps + 1, num_envs, recurrent_size)
         self.rewards = torch.zeros(num_steps, num_envs, 1)
         self.value_preds = torch.zeros(num_steps + 1, num_envs, 1)
@@ -102,6 +610,8 @@ class RolloutStorage:
         self.num_steps = num_steps
         self.num_actions = num_actions
         self.step = 0
+        self._rollout = None
+        self._staging = PinnedStaging()
 
     def insert(
         self,
@@ -122,6 +632,7 @@ class RolloutStorage:
         self.masks[self.step + 1].copy_(masks)
 
         self.step = (self.step + 1) % self.num_steps
+        self._rollout = None
 
     def after_update(self):
         self.obs[0].copy_(self.obs[-1])
@@ -129,40 +640,32 @@ class RolloutStorage:
         self.masks[0].copy_(self.masks[-1])
 
     def compute_returns(self, next_value, gamma=0.99, lda=0.95):
+        self._rollout = None
         self.value_preds[-1] = next_value
-        gae = 0
-        for step in reversed(range(self.rewards.size(0))):
-            delta = (
-                self.rewards[step]
-                + gamma * self.value_preds[step + 1]
-                - self.value_preds[step]
-            )
-            gae = delta + gamma * lda * self.masks[step + 1] * gae
-            self.returns[step] = gae + self.value_preds[step]
+        _, self.returns[:-1] = gae(
+            self.rewards, self.value_preds[:-1], 1 - self.masks[1:], next_value, gamma, lda
+        )
 
-    def generate(self, mini_batch_size):
+    def generate(self, mini_batch_size, device=None):
         # first dim is time, second dim is envs
-        total = (self.obs.shape[0] - 1) * self.obs.shape[1]
-
-        def git(tensor, i, obs=False):
-            if obs:
-                return tensor.view(-1, *tensor.size()[2:])[i : i + mini_batch_size]
-            return tensor.view(-1, tensor.size(-1))[i : i + mini_batch_size]
-
-        for i in range(0, total, mini_batch_size):  # random?
-            obs_batch = git(self.obs[:-1], i, True)
-            recur_batch = git(self.recurrent_states[:-1], i)
-            actions_batch = git(self.actions, i)
-            value_preds_batch = git(self.value_preds[:-1], i)
-            return_batch = git(self.returns[:-1], i)
-            masks_batch = git(self.masks[:-1], i)
-            old_action_log_probs_batch = git(self.action_log_probs, i)
+        # the rollout goes to device on the first call after compute_returns,
+        # later epochs reuse it with a new shuffle
+        if self._rollout is None:
 
-            try:
-                yield obs_batch.cuda(), actions_batch.cuda(), old_action_log_probs_batch.cuda(), return_batch.cuda(), (
-                    return_batch - value_preds_batch
-                ).cuda(), recur_batch.cuda()
-            except Exception:
-                import ipdb
+            def flat(tensor):
+                return tensor.reshape(-1, *tensor.size()[2:])
+
+            self._rollout = DeviceRollout(
+                [
+                    flat(self.obs[:-1]),
+                    flat(self.actions),
+                    flat(self.action_log_probs),
+                    flat(self.returns[:-1]),
+                    flat(self.returns[:-1] - self.value_preds[:-1]),
+                    flat(self.recurrent_states[:-1]),
+                ],
+                device,
+                self._staging,
+            )
 
-                ipdb.set_trace()
+        yield from self._rollout.minibatches(mini_batch_size)
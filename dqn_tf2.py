@@ -12,6 +12,7 @@ import gym
 from snake_gym import SnakeEnv
 import wandb
 from tf2_common import make_main_model
+from symmetry import BoardSymmetry
 
 
 def qvals_to_boltzman_probabilities(qvals, temp, min_temp=0.00000001):
@@ -257,7 +258,7 @@ class EpisodicReplayBuffer:
 
         return [e.get_stacked_exp(stacking) for e in epfridx]
 
-def experience_samples_to_training_input(samples):
+def experience_samples_to_training_input(samples, symmetry=None):
     obs = []
     obs_next = []
     actions = []
@@ -270,7 +271,11 @@ def experience_samples_to_training_input(samples):
         rewards.append(s.rew)
         dones.append(s.done)
 
-    return tf.constant(np.stack(obs, 0)), tf.constant(actions, dtype='int32'), tf.constant(rewards, dtype='float32'), tf.constant(np.stack(obs_next, 0)), tf.constant(dones, dtype='bool')
+    obs, obs_next = np.stack(obs, 0), np.stack(obs_next, 0)
+    if symmetry is not None:
+        obs, actions, obs_next = symmetry(obs, np.array(actions), obs_next)
+
+    return tf.constant(obs), tf.constant(actions, dtype='int32'), tf.constant(rewards, dtype='float32'), tf.constant(obs_next), tf.constant(dones, dtype='bool')
 
 @dataclass
 class RunCfg:
@@ -285,6 +290,7 @@ class RunCfg:
     steps_between_train: int
     starting_temperature: int
     temperature_decay_idx: int
+    augment: bool = False
 
 def main():
     last_test_rewards = deque(maxlen=10)
@@ -309,6 +315,13 @@ def main():
     model = SnakeModel((128, 128, cfg.stacking), 3)
     print(model.summary())
     env = gym.make('snakenv-v0', gs=gs, main_gs=main_gs)
+    # the frames in the buffer are the env's, not the model's input size. The
+    # model has no action for every direction, so only the symmetries that
+    # map its actions onto each other are used
+    symmetry = None
+    if cfg.augment:
+        symmetry = BoardSymmetry(env.observation_space.shape[:2], {a: env.unwrapped.action_map[a] for a in range(model.num_actions)},
+                                 channels_last=True, transforms='actions')
 
     replay = EpisodicReplayBuffer(100000)
 
@@ -338,7 +351,7 @@ def main():
 
         if steps_until_train <= 0:
             sample = replay.sample_frames(cfg.batch_size, stacking=cfg.stacking)
-            inp = experience_samples_to_training_input(sample)
+            inp = experience_samples_to_training_input(sample, symmetry)
             l = model.train(*inp)
             loss = float(tf.reduce_mean(l[0]))
             wandb.log({'loss': loss, 'temperature': temp_fn(i)}, step=i)
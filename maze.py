@@ -9,6 +9,7 @@ import random
 from threeviz.api import plot_3d, plot_pose, plot_line_seg
 import cv2
 from random import seed
+from recorder import EpisodeRecorder
 from maze_nn import create_maze_solving_network, predict_on_model, preprocess_image, transfer_weights_partially, add_rl_loss_to_network, make_intermediate_models, visualize_network_forward_pass
 from collections import deque
 import tensorflow as tf
@@ -181,10 +182,13 @@ def make_test_maze(s=4):
     # seed(time.time())
     return m
 
-def run_episode(m, model, eps, memory, verbose=False, max_steps=None):
+def run_episode(m, model, eps, memory, verbose=False, max_steps=None, recorder=None):
     # if not memory:
     #     memory = []
     m.reset()
+    if recorder is not None:
+        recorder.begin_episode()
+        recorder.add(m.to_image(64))
     # m.randomize_agent()
     final_score = 0
 
@@ -194,7 +198,7 @@ def run_episode(m, model, eps, memory, verbose=False, max_steps=None):
     while not m.has_ended(): # and not m.has_died():
         itr += 1
         if max_steps and itr > max_steps:
-            return memory
+            break
         # if random.random() > anneal_probability(i, max_episodes, switch_episodes, 0.5) or i < switch_episodes:
         if random.random() < eps:
             idx = random.randint(0, 3)
@@ -206,6 +210,8 @@ def run_episode(m, model, eps, memory, verbose=False, max_steps=None):
         rt, _ = m.apply_action(at)
         next_state = m.to_image(64)
         final_score += rt
+        if recorder is not None:
+            recorder.add(next_state)
 
         if verbose:
             m.visualize()
@@ -215,6 +221,8 @@ def run_episode(m, model, eps, memory, verbose=False, max_steps=None):
         memory.append(SingleStep(st=state, stn=next_state, rt=rt, at=at, done=done))
 
     # print(f"finished episode with final score of {final_score} and in {itr} iterations")
+    if recorder is not None:
+        recorder.end_episode()
     return memory
 
 def main(experiment_name, fw, starting_weights=None):
@@ -323,11 +331,14 @@ def run_training(experiment_name, starting_weights=None):
     file_writer.set_as_default()
     main(experiment_name, file_writer, starting_weights)
 
-def run_test(weights_path, side_len=4):
+def run_test(weights_path, side_len=4, record_dir=None):
     model = tf.keras.models.load_model(weights_path)
+    # record_dir writes every test episode there as a gif instead of
+    # drawing it, so it also works without a display
+    recorder = EpisodeRecorder(record_dir, fmt='gif', fps=4) if record_dir else None
     while True:
         m = make_test_maze(side_len)
-        run_episode(m, model, 0, [], True, max_steps=25)
+        run_episode(m, model, 0, [], recorder is None, max_steps=25, recorder=recorder)
 
 if __name__ == '__main__':
     # argh.dispatch_commands([run_training, run_test])
@@ -11,7 +11,9 @@ import PIL
 # Ref https://towardsdatascience.com/deep-reinforcement-learning-tutorial-with-open-ai-gym-c0de4471f368
 
 def preprocess_image(im, image_size=64, expand=True):
-    im = cv2.resize(im, (image_size, image_size))/255.0
+    if im.shape[:2] != (image_size, image_size):
+        im = cv2.resize(im, (image_size, image_size))
+    im = im/255.0
 
     if expand:
         return np.expand_dims(im, 0)
@@ -0,0 +1,126 @@
+import os
+from dataclasses import dataclass, field
+from typing import List
+
+# thread pools that read their size from the environment when they start,
+# set for the process itself and inherited by anything it launches
+_THREAD_ENV_VARS = (
+    "OMP_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+)
+
+
+def available_cpus():
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+def _cores(cpus):
+    # cpus grouped by physical core (hyperthread siblings together), as far
+    # as the kernel tells us
+    groups = {}
+    for c in cpus:
+        try:
+            with open(f"/sys/devices/system/cpu/cpu{c}/topology/thread_siblings_list") as f:
+                key = f.read().strip()
+        except OSError:
+            key = str(c)
+        groups.setdefault(key, []).append(c)
+    return list(groups.values())
+
+
+def _fmt(cpus):
+    return ",".join(map(str, cpus))
+
+
+@dataclass
+class Layout:
+    """
+    CPU sets for a learner process and its env workers, with the number of
+    threads each one may use
+    """
+
+    learner: List[int]
+    learner_threads: int
+    workers: List[List[int]] = field(default_factory=list)
+    worker_threads: int = 1
+
+    def report(self):
+        lines = [f"learner: cpus {_fmt(self.learner)}, threads {self.learner_threads}"]
+        for i, cpus in enumerate(self.workers):
+            lines.append(f"worker {i}: cpus {_fmt(cpus)}, threads {self.worker_threads}")
+        return "\n".join(lines)
+
+
+def plan_layout(num_workers=0, learner_cpus=None, cpus=None):
+    """
+    Splits cpus (the ones this process may run on by default) between the
+    learner and num_workers env workers, whole physical cores first. The
+    learner gets learner_cpus of them, a quarter by default when there are
+    workers. Workers share cpus when there are more workers than cpus left.
+    """
+    cpus = available_cpus() if cpus is None else list(cpus)
+    if num_workers == 0:
+        return Layout(cpus, len(cpus))
+
+    cores = _cores(cpus)
+    if learner_cpus is None:
+        learner_cpus = max(1, len(cpus) // 4)
+    learner = []
+    while cores and len(learner) < learner_cpus:
+        learner += cores.pop(0)
+    rest = [c for core in cores for c in core]
+    if not rest:
+        # not enough cpus to go round, everything shares everything
+        return Layout(cpus, len(cpus), [cpus] * num_workers, 1)
+
+    if num_workers <= len(rest):
+        chunks = _split(rest, num_workers)
+    else:
+        chunks = [[rest[i % len(rest)]] for i in range(num_workers)]
+    return Layout(learner, len(learner), chunks, min(len(c) for c in chunks))
+
+
+def _split(items, n):
+    k, m = divmod(len(items), n)
+    return [items[i * k + min(i, m):(i + 1) * k + min(i + 1, m)] for i in range(n)]
+
+
+def configure_process(cpus=None, threads=1):
+    """
+    Pins the calling process to cpus and caps the thread pools of torch,
+    OpenCV and BLAS at threads. Best called before those get busy.
+    """
+    if cpus is not None and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+    for var in _THREAD_ENV_VARS:
+        os.environ[var] = str(threads)
+
+    try:
+        import cv2
+
+        cv2.setNumThreads(threads)
+    except ImportError:
+        pass
+    try:
+        import torch
+
+        torch.set_num_threads(threads)
+        try:
+            torch.set_num_interop_threads(threads)
+        except RuntimeError:
+            # can only be set before torch first runs something in parallel
+            pass
+    except ImportError:
+        pass
+    try:
+        # BLAS already loaded by numpy ignores the variables above
+        from threadpoolctl import threadpool_limits
+
+        threadpool_limits(threads)
+    except ImportError:
+        pass
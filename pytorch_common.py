@@ -4,7 +4,7 @@ import torch
 import numpy as np
 import torch.nn as nn
 import torch.optim as optim
-from common import EnvManager, compute_gae
+from common import EnvManager, DeviceRollout, PinnedStaging, compute_gae
 import gym
 from snake_gym import SnakeEnv
 import vizdoomgym
@@ -21,30 +21,18 @@ def init(module, weight_init, bias_init, gain=1):
 def ppo_iter(
     mini_batch_size, states, actions, log_probs, returns, advantage, r_states, device
 ):
-    batch_size = states.size(0)
-    for i in range(batch_size // mini_batch_size):
-        out_rstates = (
-            torch.zeros((1, 1))
-            if isinstance(r_states, list)
-            else r_states[i * mini_batch_size : (i + 1) * mini_batch_size, :].to(device)
-        )
-        yield states[i * mini_batch_size : (i + 1) * mini_batch_size, :].to(
-            device
-        ), actions[i * mini_batch_size : (i + 1) * mini_batch_size, :].to(
-            device
-        ), log_probs[
-            i * mini_batch_size : (i + 1) * mini_batch_size, :
-        ].to(
-            device
-        ), returns[
-            i * mini_batch_size : (i + 1) * mini_batch_size, :
-        ].to(
-            device
-        ), advantage[
-            i * mini_batch_size : (i + 1) * mini_batch_size, :
-        ].to(
-            device
-        ), out_rstates
+    """one shuffled epoch, ppo_update keeps the DeviceRollout across epochs"""
+    rollout = DeviceRollout(
+        [states, actions, log_probs, returns, advantage, None if isinstance(r_states, list) else r_states],
+        device,
+    )
+    return _ppo_batches(rollout, mini_batch_size)
+
+
+def _ppo_batches(rollout, mini_batch_size):
+    no_rstates = torch.zeros((1, 1), device=rollout.device)
+    for *batch, r_state in rollout.minibatches(mini_batch_size, drop_last=True):
+        yield (*batch, no_rstates if r_state is None else r_state)
 
 
 class CuriosityTracker(nn.Module):
@@ -250,16 +238,16 @@ class VisualAgentPPO(nn.Module):
         fcritic_loss = 0
         fentropy_loss = 0
         final_loss_steps = 0
+        if not hasattr(self, "_staging"):
+            self._staging = PinnedStaging()
+        rollout = DeviceRollout(
+            [states, actions, log_probs, returns, advantages, None if isinstance(r_states, list) else r_states],
+            self.device,
+            self._staging,
+        )
         for _ in tqdm(range(ppo_epochs)):
-            for state, action, old_log_probs, return_, advantage, r_state in ppo_iter(
-                mini_batch_size,
-                states,
-                actions,
-                log_probs,
-                returns,
-                advantages,
-                r_states,
-                self.device,
+            for state, action, old_log_probs, return_, advantage, r_state in _ppo_batches(
+                rollout, mini_batch_size
             ):
                 dist, value, _ = model(state, r_state)
                 entropy = dist.entropy().mean()
@@ -4,12 +4,13 @@ ray.init(num_cpus=8)
 
 import time
 import os
+from functools import partial
 from tqdm import tqdm
 import torch
 import numpy as np
 import torch.nn as nn
 import torch.optim as optim
-from common import EnvManager, compute_gae
+from common import EnvManager, compute_gae, pipelined_steps
 import gym
 from snake_gym import SnakeEnv
 import vizdoomgym
@@ -17,6 +18,7 @@ import wandb
 import argh
 from common import RolloutStorage
 from pytorch_common import _t, VisualAgentPPO
+from placement import plan_layout, configure_process
 import torch.multiprocessing as mp
 from multiprocessing import Queue
 
@@ -29,7 +31,10 @@ def make_doom_deathmatch():
 
 @ray.remote(num_cpus=0.5)
 class Runner:
-    def __init__(self, num_envs=32, reward_mult=0.001, skip=1):
+    def __init__(self, num_envs=32, reward_mult=0.001, skip=1, cpus=None, threads=1):
+        # pinned to cpus with every thread pool capped at threads, the envs
+        # share those threads instead of getting one each
+        configure_process(cpus, threads)
         print("making envs")
         self.m = EnvManager(
             make_doom_deathmatch,
@@ -38,9 +43,13 @@ class Runner:
             num_viz_train=0,
             reward_mult=reward_mult,
             skip=skip,
+            num_threads=max(threads, len(cpus) if cpus else 1),
         )
         print("done making envs")
 
+    def get_state(self):
+        return self.m.state
+
     def step(self, actions):
         _, r, d, idicts = self.m.apply_actions(actions)
         state_buffer = self.m.state
@@ -54,14 +63,38 @@ def tcat(l, idx):
     # return torch.cat([i[idx] for i in l])
 
 
-def main(num_procs=8, num_envs=32, num_steps=32):
+class RunnerGroup:
+    """
+    Runners stepped together, with the step_async/step_wait interface of
+    EnvManager so common.pipelined_steps can drive them
+    """
+
+    def __init__(self, runners, num_envs):
+        self.runners = runners
+        self.num_envs = num_envs
+        self.state = torch.cat([torch.Tensor(s) for s in ray.get([r.get_state.remote() for r in runners])])
+        self._refs = None
+
+    def step_async(self, actions):
+        n = self.num_envs
+        self._refs = [r.step.remote(actions[i * n : (i + 1) * n]) for i, r in enumerate(self.runners)]
+
+    def step_wait(self):
+        row = ray.get(self._refs)
+        self._refs = None
+        out_state, self.state = self.state, tcat(row, 0)
+        return out_state, tcat(row, 1), tcat(row, 2), [d for r in row for d in r[-1]]
+
+
+def main(num_procs=8, num_envs=32, num_steps=32, double_buffer=False):
+    mini_batch_size = 512 + 256 + 128
     wandb.init(project="snake-pytorch-ppo", tags="deathmatch_parallel")
     idx = 0
     batch_num = 0
     device = "cuda"
     recurrent = True
     recurrent_size = 256 if recurrent else 0
-    recurrent_state = torch.zeros((num_envs * num_procs, recurrent_size))
+    recurrent_state = torch.zeros((num_envs * num_procs, recurrent_size), device=device)
 
     obs_shape = (3, 240 // 2, 320 // 2)
     num_actions = 7
@@ -70,47 +103,58 @@ def main(num_procs=8, num_envs=32, num_steps=32):
         obs_shape, num_actions, device=device, recurrent=recurrent_size, smaller=True
     ).to(device)
     storage = RolloutStorage(
-        num_steps, num_envs * num_procs, obs_shape, num_actions, recurrent_size
+        num_steps, num_envs * num_procs, obs_shape, num_actions, recurrent_size, obs_dtype=torch.uint8
     )
 
-    runners = [Runner.remote(num_envs) for _ in range(num_procs)]
+    layout = plan_layout(num_procs)
+    configure_process(layout.learner, layout.learner_threads)
+    print(layout.report())
+    runners = [Runner.remote(num_envs, cpus=cpus, threads=layout.worker_threads) for cpus in layout.workers]
+    # double_buffer runs the model on half of the runners while the other
+    # half is stepping
+    half = num_procs // 2 if double_buffer and num_procs > 1 else num_procs
+    groups = [RunnerGroup(rs, num_envs) for rs in [runners[:half], runners[half:]] if rs]
+    slices = [
+        slice(num_envs * a, num_envs * b) for a, b in [(0, half), (half, num_procs)][: len(groups)]
+    ]
+    state = torch.cat([g.state for g in groups])
+    storage.obs[0].copy_(state)
+
+    def policy(g, obs):
+        sl = slices[g]
+        with torch.no_grad():
+            act_dist, vals, recurrent_state[sl] = model(obs.to(device), recurrent_state[sl].clone())
+        action_sample = act_dist.sample()
+        return action_sample.cpu(), (
+            action_sample.unsqueeze(1),
+            act_dist.log_prob(action_sample).unsqueeze(1),
+            vals,
+        )
 
     tq = None
     once_done = False
     while True:
         scores = []
-        for i in range(num_steps):
-            s = storage.step
-
-            with torch.no_grad():
-                act_dist, vals, recurrent_state = model(
-                    storage.obs[s].to(device), storage.recurrent_states[s].to(device)
-                )
-            action_sample = act_dist.sample()  # num_envs * num_procs
-
-            row = ray.get(
-                [
-                    r.step.remote(
-                        action_sample[_i * num_envs : (_i + 1) * num_envs].cpu()
-                    )
-                    for _i, r in enumerate(runners)
-                ]
-            )
-
-            state, rewards, dones = tcat(row, 0), tcat(row, 1), tcat(row, 2)
-            for i, d in enumerate(dones):
+        step_results = [None] * len(groups)
+        for i, g, outputs, (_, rewards, dones, idicts) in pipelined_steps(groups, policy, num_steps):
+            sl = slices[g]
+            for k, d in enumerate(dones):
                 if d:
-                    for r in row:
-                        for _d in r[-1]:
-                            if "score" in _d:
-                                scores.append(_d["score"])
-                    recurrent_state[i] = 0
-
+                    recurrent_state[sl.start + k] = 0
+            scores.extend(_d["score"] for _d in idicts if "score" in _d)
+            step_results[g] = (groups[g].state, recurrent_state[sl].clone()) + outputs + (rewards, dones)
+            if g < len(groups) - 1:
+                continue
+
+            # every group has finished step i
+            state, r_state, actions, log_probs, vals, rewards, dones = [
+                torch.cat(parts) for parts in zip(*step_results)
+            ]
             storage.insert(
                 state,
-                recurrent_state,
-                action_sample.unsqueeze(1),
-                act_dist.log_prob(action_sample).unsqueeze(1),
+                r_state,
+                actions,
+                log_probs,
                 vals,
                 rewards,
                 1 - dones,
@@ -129,7 +173,7 @@ def main(num_procs=8, num_envs=32, num_steps=32):
         storage.compute_returns(next_vals)
 
         _, actor_loss, critic_loss, entropy_loss = model.ppo_update_generator(
-            storage.generate, 512 + 256 + 128, 2, 0.1
+            partial(storage.generate, device=device), mini_batch_size, 2, 0.1
         )
 
         storage.after_update()
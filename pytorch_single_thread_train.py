@@ -1,19 +1,23 @@
 import os
+from functools import partial
 from tqdm import tqdm
 import torch
 import numpy as np
 import torch.nn as nn
 import torch.optim as optim
-from common import EnvManager, compute_gae
+from common import EnvManager, ProcessEnvManager, make_env_groups, pipelined_steps
+import returns
 import gym
 from snake_gym import SnakeEnv
 import vizdoomgym
 import wandb
 import argh
-from pytorch_common import _t, VisualAgentPPO, CuriosityTracker
+from pytorch_common import VisualAgentPPO, CuriosityTracker
+from placement import plan_layout, configure_process
+from autotune import load_config
 
 
-def main(device="cuda", env_name="snake", test=False, checkpoint_path=None):
+def main(device="cuda", env_name="snake", test=False, checkpoint_path=None, num_workers=0, double_buffer=False, tuned=None):
     assert env_name in [
         "snake",
         "doom_basic",
@@ -32,8 +36,15 @@ def main(device="cuda", env_name="snake", test=False, checkpoint_path=None):
         num_envs = 4
         num_viz_train = 2
     num_steps = 8 * 2
+    mini_batch_size = 1024
+    # tuned is a config written by autotune.py for this machine, which only
+    # measures the snake setup
+    if tuned is not None and not test:
+        cfg = load_config(tuned, env_name)
+        num_envs, num_steps = cfg["num_envs"], cfg["num_steps"]
+        num_workers, mini_batch_size = cfg["num_workers"], cfg["mini_batch_size"]
     if env_name == "snake":
-        env_fac = lambda: gym.make("snakenv-v0", gs=20, main_gs=22, num_fruits=1)
+        env_fac = lambda: gym.make("snakenv-v0", gs=20, main_gs=22, num_fruits=1, obs_mode="tiles")
     elif env_name == "doom_basic":
         env_fac = lambda: gym.make("VizdoomBasic-v0")
     elif env_name == "doom_corridor":
@@ -55,15 +66,34 @@ def main(device="cuda", env_name="snake", test=False, checkpoint_path=None):
     skip = 1 if env_name not in ["doom_corridor", "doom_way", "doom_deathmatch"] else 4
     skip = 1
 
-    m = EnvManager(
+    # pin the learner and the env workers to their own cores and size every
+    # thread pool to fit
+    layout = plan_layout(num_workers)
+    configure_process(layout.learner, layout.learner_threads)
+    print(layout.report())
+
+    # num_workers > 0 steps the envs in that many processes instead of threads,
+    # double_buffer splits them in two groups so the model runs on one while
+    # the other is stepping
+    if num_workers == 0:
+        manager = partial(EnvManager, num_threads=layout.learner_threads)
+    else:
+        manager = partial(ProcessEnvManager, num_workers=num_workers, layout=layout)
+    groups = make_env_groups(
+        manager,
         env_fac,
         num_envs,
+        double_buffer=double_buffer,
         pytorch=True,
         num_viz_train=num_viz_train,
         reward_mult=reward_mult,
         skip=skip,
+        batch_render=env_name == "snake",
     )
-    s = m.state.shape
+    bounds = np.cumsum([0] + [len(g.state) for g in groups])
+    slices = [slice(a, b) for a, b in zip(bounds[:-1], bounds[1:])]
+    env_state = lambda: np.concatenate([g.state for g in groups])
+    s = groups[0].state.shape
 
     if env_name == "snake":
         model = VisualAgentPPO(
@@ -98,33 +128,32 @@ def main(device="cuda", env_name="snake", test=False, checkpoint_path=None):
     batch_num = 0
     episode_num = 0
 
-    recurrent_state = torch.zeros((num_envs, recurrent_size))
+    recurrent_state = torch.zeros((num_envs, recurrent_size), device=device)
+
+    def policy(g, state):
+        sl = slices[g]
+        r_state = recurrent_state[sl].clone()
+        dist, v, recurrent_state[sl] = model(torch.FloatTensor(state).to(device), r_state)
+        if not test:
+            acts = dist.sample()
+        else:
+            acts = dist.logits.max(1).indices.view(-1)
+        return acts.tolist(), (r_state.cpu(), v, dist.log_prob(acts), acts)
 
     while True:
-        states = []
         state_next_state = []
-        r_states = []
-        values = []
-        rewards = []
-        dones = []
-        actions = []
         info_dicts = []
-        log_probs = []
         scores = []
+        # per group lists of (obs, reward, done, value, log prob, action,
+        # recurrent state) for every step
+        rollout = [[] for _ in groups]
 
         with torch.no_grad():
-            for i in range(num_steps):
-                if recurrent:
-                    r_states.append(recurrent_state.cpu())
-                dist, v, recurrent_state = model(
-                    torch.FloatTensor(m.state).to(device), recurrent_state.to(device)
-                )
-                idx += num_envs
-                if not test:
-                    acts = dist.sample()
-                else:
-                    acts = dist.logits.max(1).indices.view(-1)
-                ost, r, d, idicts = m.apply_actions(acts.tolist())
+            for step, g, (r_state, v, log_prob, acts), (ost, r, d, idicts) in pipelined_steps(
+                groups, policy, num_steps
+            ):
+                sl = slices[g]
+                idx += len(d)
 
                 curiosity_output = curiosity_model(torch.FloatTensor(ost).to(device))
                 curiosity_target_output = curiosity_target(
@@ -142,19 +171,14 @@ def main(device="cuda", env_name="snake", test=False, checkpoint_path=None):
                 if not test:
                     for i, (st, dn) in enumerate(zip(ost, d)):
                         if not dn:
-                            state_next_state.append((st, m.state[i]))
+                            state_next_state.append((st.copy(), groups[g].state[i].copy()))
 
-                    states.append(ost)
-                    rewards.append(r + intrinsic_reward)
-                    dones.append(d)
-                    values.append(v)
-                    log_prob = dist.log_prob(acts)
-                    log_probs.append(log_prob)
-                    actions.append(acts)
+                    # the manager reuses its buffers on the next step
+                    rollout[g].append((ost.copy(), r + intrinsic_reward, d.copy(), v, log_prob, acts, r_state))
 
                 for i, dun in enumerate(d):
                     if dun:
-                        recurrent_state[i] = 0
+                        recurrent_state[sl.start + i] = 0
 
                 if any(d):
                     episode_num += 1
@@ -162,27 +186,42 @@ def main(device="cuda", env_name="snake", test=False, checkpoint_path=None):
                         [idict["score"] for idict in idicts if "score" in idict]
                     )
 
+        # put the groups back together, envs in group order at every step
+        states, rewards, dones, values, log_probs, actions, r_states = [
+            [
+                (np.concatenate if k < 3 else torch.cat)([rollout[g][t][k] for g in range(len(groups))])
+                for t in range(len(rollout[0]))
+            ]
+            for k in range(7)
+        ]
+
         if not test:
-            gae_ = compute_gae(
-                model(
-                    torch.FloatTensor(m.state).to(device), recurrent_state.to(device)
-                )[1].cpu(),
-                rewards,
-                dones,
-                [v.cpu() for v in values],
+            with torch.no_grad():
+                next_value = model(torch.FloatTensor(env_state()).to(device), recurrent_state)[1]
+            # [T, N, 1] on the device, flattened step major like the rest
+            _, gae = returns.gae(
+                torch.as_tensor(np.stack(rewards), dtype=torch.float32, device=device),
+                torch.stack(values).detach(),
+                np.stack(dones),
+                next_value,
+                gamma=0.999,
+                lmbda=0.98,
             )
-            gae = _t(gae_)
+            gae = gae.reshape(-1, 1)
             values = torch.cat(values)
             log_probs = torch.cat(log_probs).unsqueeze(-1)
-            advantage = gae.to(device) - values
+            advantage = gae - values
             actions = torch.cat(actions).unsqueeze(-1)
-            states = _t(states)
+            # frames go up as uint8 and become float on the device
+            states = torch.from_numpy(np.concatenate(states))
+            if states.dtype != torch.uint8:
+                states = states.float()
             if recurrent:
                 r_states = torch.cat(r_states)
 
             loss, actor_loss, critic_loss, entropy_loss = model.ppo_update(
                 4,
-                min(num_envs * num_steps, 1024),
+                min(num_envs * num_steps, mini_batch_size),
                 states,
                 actions,
                 log_probs,
@@ -192,8 +231,9 @@ def main(device="cuda", env_name="snake", test=False, checkpoint_path=None):
             )
 
             curiosity_model.optimizer.zero_grad()
-            intrinsic_target = curiosity_target(states.to(device))
-            intrinsic_actual = curiosity_model(states.to(device))
+            dev_states = states.to(device).float()
+            intrinsic_target = curiosity_target(dev_states)
+            intrinsic_actual = curiosity_model(dev_states)
 
             intrinsic_loss = nn.functional.mse_loss(intrinsic_actual, intrinsic_target)
             intrinsic_loss.backward()
@@ -0,0 +1,157 @@
+import os
+import queue
+import threading
+import numpy as np
+import cv2
+
+
+class EpisodeRecorder:
+    """
+    Writes every `every`-th episode to path as a video (any extension
+    cv2.VideoWriter can encode, mp4 by default) or a gif. Frames are uint8
+    [H, W] grey or [H, W, 3] RGB arrays, or anything decode turns into one
+    (e.g. the Env.to_bytes of a snake game), and are encoded by a background
+    thread. The queue between the two is bounded and frames that don't fit
+    are dropped rather than waited for, so recording never holds up the
+    stepping loop and needs no display.
+
+        rec = EpisodeRecorder('/tmp/episodes', every=100)
+        rec.begin_episode()
+        while not done:
+            ...
+            rec.add(frame)
+        rec.end_episode()
+        rec.close()
+    """
+
+    def __init__(self, path, every=1, fps=15, fmt='mp4', size=None, max_queue=1024, decode=None):
+        self.path = path
+        self.every = every
+        self.fps = fps
+        self.fmt = fmt
+        self.size = size
+        self.decode = decode
+        self.episode = -1
+        self.recording = False
+        self.dropped = 0
+        self.written = 0
+        # what stopped the writer thread, raised again by close
+        self.error = None
+        os.makedirs(path, exist_ok=True)
+        self._queue = queue.Queue(max_queue)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def begin_episode(self):
+        self.episode += 1
+        self.recording = self.episode % self.every == 0
+
+    def add(self, frame):
+        if not self.recording or self.error is not None:
+            return
+        if self.decode is None:
+            frame = np.array(frame, dtype=np.uint8)
+        try:
+            self._queue.put_nowait((self.episode, frame))
+        except queue.Full:
+            self.dropped += 1
+
+    def end_episode(self):
+        # episodes are also closed off when the next one's frames arrive, so
+        # losing this marker to a full queue only delays the file
+        if self.recording:
+            self.recording = False
+            try:
+                self._queue.put_nowait((self.episode, None))
+            except queue.Full:
+                pass
+
+    def close(self):
+        self.recording = False
+        # a dead writer leaves the queue full, only wait for room while it runs
+        while self._thread.is_alive():
+            try:
+                self._queue.put(None, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        self._thread.join()
+        if self.error is not None:
+            raise RuntimeError(f"recording to {self.path} failed") from self.error
+
+    def _frame(self, item):
+        frame = item if self.decode is None else self.decode(item)
+        if self.size is not None:
+            frame = cv2.resize(frame, self.size, interpolation=cv2.INTER_NEAREST)
+        if frame.ndim == 2:
+            frame = np.dstack((frame, frame, frame))
+        return frame
+
+    def _run(self):
+        try:
+            self._write()
+        except Exception as e:
+            self.error = e
+
+    def _write(self):
+        writer = None
+        while True:
+            item = self._queue.get()
+            episode, frame = (None, None) if item is None else item
+            if writer is not None and episode != writer.episode:
+                writer.close()
+                self.written += 1
+                writer = None
+            if item is None:
+                return
+            if frame is None:
+                continue
+            frame = self._frame(frame)
+            if writer is None:
+                name = os.path.join(self.path, f"episode_{episode:06d}.{self.fmt}")
+                writer = (_GifWriter if self.fmt == 'gif' else _VideoWriter)(name, self.fps, frame.shape)
+                writer.episode = episode
+            writer.write(frame)
+
+
+class _VideoWriter:
+    def __init__(self, name, fps, shape):
+        fourcc = cv2.VideoWriter_fourcc(*('mp4v' if name.endswith('.mp4') else 'MJPG'))
+        self.writer = cv2.VideoWriter(name, fourcc, fps, (shape[1], shape[0]))
+
+    def write(self, frame):
+        self.writer.write(cv2.cvtColor(frame, cv2.COLOR_RGB2BGR))
+
+    def close(self):
+        self.writer.release()
+
+
+class _GifWriter:
+    def __init__(self, name, fps, shape):
+        self.name = name
+        self.duration = int(1000 / fps)
+        self.frames = []
+
+    def write(self, frame):
+        self.frames.append(frame)
+
+    def close(self):
+        from PIL import Image
+
+        images = [Image.fromarray(f) for f in self.frames]
+        images[0].save(self.name, format='GIF', save_all=True, append_images=images[1:],
+                       loop=0, duration=self.duration)
+
+
+def snake_decoder(gs, main_gs=None, scale=8):
+    """decode for EpisodeRecorder, turns Env.to_bytes states back into frames"""
+    from snake import Env
+
+    env = Env(gs, main_gs=gs if main_gs is None else main_gs, scale=scale)
+    env.reset()
+
+    def decode(data):
+        env.from_bytes(data)
+        return env.to_image(copy=False)
+
+    return decode
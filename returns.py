@@ -0,0 +1,100 @@
+"""
+Returns and advantages over whole rollouts. Arrays are [T, N, ...] (time
+first, any trailing shape), numpy or torch, and results come back the same
+kind. dones[t] marks the episode ending with the transition taken at step t,
+so nothing after it is carried back into step t. Bootstrap and next values
+are [N, ...], the value of the state reached after the last step.
+"""
+import numpy as np
+
+
+def _is_torch(x):
+    return type(x).__module__.split('.')[0] == 'torch'
+
+
+def _as_float(rewards):
+    if _is_torch(rewards):
+        return rewards if rewards.is_floating_point() else rewards.float()
+    rewards = np.asarray(rewards)
+    return rewards if rewards.dtype.kind == 'f' else rewards.astype(np.float32)
+
+
+def _like(x, like):
+    # dones come as bools, values as whatever the model returned
+    if _is_torch(like):
+        import torch
+
+        return torch.as_tensor(x, device=like.device).to(like.dtype)
+    return np.asarray(x, dtype=like.dtype)
+
+
+def _zeros(like):
+    if _is_torch(like):
+        import torch
+
+        return torch.zeros_like(like)
+    return np.zeros_like(like)
+
+
+def discounted_returns(rewards, dones=None, bootstrap=None, gamma=0.99):
+    """
+    R_t = r_t + gamma * (1 - done_t) * R_t+1 with R_T = bootstrap. With no
+    dones and no bootstrap these are the Monte Carlo returns of one episode.
+    """
+    rewards = _as_float(rewards)
+    masks = None if dones is None else 1 - _like(dones, rewards)
+    running = _zeros(rewards[0]) if bootstrap is None else _like(bootstrap, rewards)
+    out = _zeros(rewards)
+    for t in reversed(range(len(rewards))):
+        running = rewards[t] + gamma * (running if masks is None else masks[t] * running)
+        out[t] = running
+    return out
+
+
+def n_step_returns(rewards, values, dones, next_value, n, gamma=0.99):
+    """
+    R_t = sum_k<h gamma^k r_t+k + gamma^h V_t+h with h = min(n, T - t),
+    cut short where an episode ends. values are V_0..V_T-1, next_value V_T.
+    """
+    rewards = _as_float(rewards)
+    T = len(rewards)
+    masks = 1 - _like(dones, rewards)
+    values = _like(values, rewards)
+    next_value = _like(next_value, rewards)
+
+    # one pass per lookahead step, alive[t] = no episode end in t..t+k-1
+    out = _zeros(rewards)
+    alive = 1 - _zeros(rewards)
+    for k in range(min(n, T)):
+        out[:T - k] += gamma ** k * alive[:T - k] * rewards[k:]
+        alive[:T - k] = alive[:T - k] * masks[k:]
+
+    h = np.minimum(n, T - np.arange(T))
+    idx = np.arange(T) + h
+    discount = _like((gamma ** h).reshape((T,) + (1,) * (rewards.ndim - 1)), rewards)
+    if _is_torch(rewards):
+        import torch
+
+        bootstrap = torch.cat([values, next_value[None]])[torch.as_tensor(idx, device=rewards.device)]
+    else:
+        bootstrap = np.concatenate([values, next_value[None]])[idx]
+    return out + discount * alive * bootstrap
+
+
+def gae(rewards, values, dones, next_value, gamma=0.99, lmbda=0.95):
+    """
+    Generalised advantage estimation. values are V_0..V_T-1, next_value V_T.
+    Returns (advantages, returns) with returns = advantages + values.
+    """
+    rewards = _as_float(rewards)
+    masks = 1 - _like(dones, rewards)
+    values = _like(values, rewards)
+    next_value = _like(next_value, rewards)
+    advantages = _zeros(rewards)
+    running = _zeros(rewards[0])
+    for t in reversed(range(len(rewards))):
+        nxt = next_value if t == len(rewards) - 1 else values[t + 1]
+        delta = rewards[t] + gamma * nxt * masks[t] - values[t]
+        running = delta + gamma * lmbda * masks[t] * running
+        advantages[t] = running
+    return advantages, advantages + values
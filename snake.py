@@ -1,6 +1,10 @@
 import numpy as np
 import cv2
-from random import choice, randint, sample, seed
+from random import Random, choice, randint, randrange, sample, seed, getstate, setstate
+from functools import lru_cache
+from array import array
+import copy
+import struct
 from dataclasses import dataclass
 from enum import Enum
 import math
@@ -12,6 +16,14 @@ class SnakeState(Enum):
     WON = 4
 
 
+reward_map = {
+    SnakeState.OK: -0.001,
+    SnakeState.ATE: 1,
+    SnakeState.DED: -1,
+    SnakeState.WON: 1
+}
+
+
 def _rotate_image(cv_image, _rotation_angle):
     axes_order = (1, 0, 2) if len(cv_image.shape) == 3 else (1, 0)
     if _rotation_angle == -90:
@@ -68,6 +80,7 @@ dir_map_to_angle = {
     Point(1, 0): -90,
 }
 
+
 sprites = {
     'head': cv2.imread('./sprites/head.png', 0),
     'body': cv2.imread('./sprites/body.png', 0),
@@ -76,67 +89,384 @@ sprites = {
     'tail': cv2.imread('./sprites/tail.png', 0),
 }
 
+
+
+@lru_cache(maxsize=None)
+def scaled_sprites(h=8, w=8):
+    """
+    every sprite pre-rotated by each rendering angle and resized to h x w,
+    as {name: {angle: image}}
+    """
+    out = {}
+    for name, im in sprites.items():
+        out[name] = {}
+        for angle in (0, 90, -90, 180, -180):
+            r = _rotate_image(im, angle)
+            if r.shape != (h, w):
+                shrink = h <= r.shape[0] and w <= r.shape[1]
+                r = cv2.resize(r, (w, h), interpolation=cv2.INTER_AREA if shrink else cv2.INTER_NEAREST)
+            out[name][angle] = np.ascontiguousarray(r)
+    return out
+
+
+def _cell_bounds(main_gs, scale=8, image_size=None):
+    # pixel offset of every cell edge, cells differ by at most one pixel
+    # when image_size is not a multiple of main_gs
+    if image_size is None:
+        return tuple(i * scale for i in range(main_gs + 1))
+    return tuple(i * image_size // main_gs for i in range(main_gs + 1))
+
 action_dir_order = ['right', 'up', 'left', 'down']
 
+# internally directions are indices into action_dir_order and cells are
+# y*gs+x ints, these tables stand in for Point math and Point keyed dicts
+_dir_points = tuple(action_dir_map[a] for a in action_dir_order)
+_dir_ids = {a: i for i, a in enumerate(action_dir_order)}
+_dir_angles = tuple(dir_map_to_angle[p] for p in _dir_points)
+
+
+def _turn_angle(d1, d2):
+    if (d1.x > 0 and d2.y < 0) or (d1.y > 0 and d2.x < 0):
+        return 0
+    elif (d1.y > 0 and d2.x > 0) or (d1.x < 0 and d2.y < 0):
+        return -90
+    elif (d1.x > 0 and d2.y > 0) or (d1.y < 0 and d2.x < 0):
+        return 90
+    elif (d1.y < 0 and d2.x > 0) or (d1.x < 0 and d2.y > 0):
+        return 180
+    return None
+
+
+# _turn_angles[d1][d2]: rotation of the turn sprite for a segment entered
+# moving in d2 and left moving in d1
+_turn_angles = tuple(tuple(_turn_angle(p1, p2) for p2 in _dir_points) for p1 in _dir_points)
+
+
+@lru_cache(maxsize=None)
+def _grid_cells(gs):
+    return tuple(range(gs * gs))
+
+
+@lru_cache(maxsize=None)
+def _grid_points(gs):
+    # cell id y*gs+x -> Point, shared by every env with the same grid size
+    return tuple(Point(c % gs, c // gs) for c in range(gs * gs))
+
+
+@lru_cache(maxsize=None)
+def _neighbours(gs):
+    # _neighbours(gs)[d][cell] is the cell one step away in direction d, -1 off the grid
+    return tuple(
+        tuple((c // gs + p.y) * gs + c % gs + p.x
+              if 0 <= c % gs + p.x < gs and 0 <= c // gs + p.y < gs else -1
+              for c in range(gs * gs))
+        for p in _dir_points)
+
+
+@lru_cache(maxsize=None)
+def _zobrist_keys(gs):
+    # 64 bit keys for a head, a tail segment left in each direction and a
+    # fruit on every cell, seeded per grid size so hashes are reproducible
+    rng = Random(gs)
+    cells = range(gs * gs)
+    head = tuple(rng.getrandbits(64) for _ in cells)
+    segment = tuple(tuple(rng.getrandbits(64) for _ in cells) for _ in _dir_points)
+    fruit = tuple(rng.getrandbits(64) for _ in cells)
+    return head, segment, fruit
+
+
+# gs, head cell, head x, head y, direction, tail size, last ate, tail length,
+# fruit count, has rng state
+_STATE_HEADER = struct.Struct('<9i?')
+# random module state version, has gauss_next, gauss_next
+_RNG_HEADER = struct.Struct('<i?d')
+
 
 class Env:
-    def __init__(self, grid_size=10, main_gs=10, num_fruits=10):
+    def __init__(self, grid_size=10, main_gs=10, num_fruits=10, detect_loops=False, loop_state=None,
+                 scale=8, image_size=None):
+        if main_gs < grid_size:
+            raise ValueError(f"main_gs {main_gs} is smaller than the board, grid_size {grid_size}")
         self.gs = grid_size
         self.subgrid_loc = None
         self.main_gs = main_gs
+        # to_image draws scale pixels per cell, or fits the board to an
+        # image_size square when that is given
+        assert scale >= 1, "scale is the number of pixels per cell"
+        self.scale = scale
+        self.image_size = image_size
+        self._bounds = _cell_bounds(main_gs, scale, image_size)
+        sizes = {b - a for a, b in zip(self._bounds, self._bounds[1:])}
+        self._sprites = {(h, w): scaled_sprites(h, w) for h in sizes for w in sizes}
         self.num_fruits = num_fruits
+        # with detect_loops an exact repeat of the board since the last fruit
+        # sets self.looped, and update returns loop_state if one is given
+        self.detect_loops = detect_loops
+        self.loop_state = loop_state
+        self.looped = False
+        self.board_hash = 0
+        self._canvas = None
         self.reset()
 
         self.update()
 
     def reset(self):
         self.step = 0
+        self._invalidate_canvas()
         self.last_ate = 0
         grid_size = self.gs
         # self.subgrid_loc = Point(randint(0, self.main_gs - self.gs), randint(0, self.main_gs - self.gs))
         self.subgrid_loc = Point(0, 0)
-        if grid_size in [10, 20, 38]:
+        if grid_size in [10, 20, 38] and self.main_gs > grid_size:
+            # only where the offset board still fits the canvas
             self.subgrid_loc = Point(1, 1)
-        self.snake = Snake()
+        self.snake = Snake(grid_size=grid_size)
         self.snake.head = Point(self.gs//2, self.gs//2)
 
-        pos_list = []
-        for i in range(grid_size):
-            for j in range(grid_size):
-                pos_list.append(Point(i, j))
-
-        self.pos_set = set(pos_list)
-        self.fruit_locations = []
+        self.pos_list = _grid_points(grid_size)
+        self.fruit_cells = []
+        self._rebuild_grid()
+        self._rehash()
         self.set_fruits()
+        self.looped = False
+        self.seen_hashes = {self.board_hash}
+
+    def _invalidate_canvas(self):
+        # the next to_image draws the whole board
+        self._canvas_step = None
+        self._canvas_snake = None
+
+    def _rebuild_grid(self):
+        # occupancy counts snake segments per cell, fruit_grid flags fruit cells
+        # and free_cells holds every cell with neither, free_index maps a cell
+        # back to its slot in free_cells so it can be swap-removed in O(1)
+        gs = self.gs
+        self.occupancy = bytearray(gs * gs)
+        self.fruit_grid = bytearray(gs * gs)
+        self.free_cells = list(_grid_cells(gs))
+        self.free_index = list(_grid_cells(gs))
+        if self.snake.head_cell >= 0:
+            self._occupy(self.snake.head_cell)
+        for c in self.snake.tail_cells():
+            if c >= 0:
+                self._occupy(c)
+        for c in self.fruit_cells:
+            self._take_free(c)
+            self.fruit_grid[c] = 1
+
+    def _rehash(self):
+        if not self.detect_loops:
+            return
+        head_keys, segment_keys, fruit_keys = _zobrist_keys(self.gs)
+        snake = self.snake
+        h = head_keys[snake.head_cell] if snake.head_cell >= 0 else 0
+        for i in range(snake.tail_len):
+            c = snake.tail_cell(i)
+            if c >= 0:
+                h ^= segment_keys[snake.tail_dir(i)][c]
+        for c in self.fruit_cells:
+            h ^= fruit_keys[c]
+        self.board_hash = h
+        self.seen_hashes = {h}
+
+    def _hash_move(self):
+        # the old head became the neck segment and the head moved on
+        head_keys, segment_keys, _ = _zobrist_keys(self.gs)
+        snake = self.snake
+        neck = snake.tail_cell(0)
+        if neck >= 0:
+            self.board_hash ^= head_keys[neck] ^ segment_keys[snake.tail_dir(0)][neck]
+        if snake.head_cell >= 0:
+            self.board_hash ^= head_keys[snake.head_cell]
+
+    def _hash_shed(self):
+        # call before popping the tail tip
+        snake = self.snake
+        tip = snake.tail_cell(snake.tail_len - 1)
+        if tip >= 0:
+            self.board_hash ^= _zobrist_keys(self.gs)[1][snake.tail_dir(snake.tail_len - 1)][tip]
+
+    def _check_loop(self, out_enum):
+        if out_enum is not SnakeState.OK:
+            # eating changes the length, so no earlier board can come back
+            self.seen_hashes.clear()
+        self.looped = self.board_hash in self.seen_hashes
+        self.seen_hashes.add(self.board_hash)
+        if self.looped and self.loop_state is not None and out_enum is SnakeState.OK:
+            return self.loop_state
+        return out_enum
+
+    def _cell(self, pos):
+        return pos.y * self.gs + pos.x
+
+    def _take_free(self, cell):
+        i = self.free_index[cell]
+        last = self.free_cells.pop()
+        if last != cell:
+            self.free_cells[i] = last
+            self.free_index[last] = i
+
+    def _give_free(self, cell):
+        self.free_index[cell] = len(self.free_cells)
+        self.free_cells.append(cell)
+
+    def _occupy(self, cell):
+        self.occupancy[cell] += 1
+        if self.occupancy[cell] == 1 and not self.fruit_grid[cell]:
+            self._take_free(cell)
+
+    def _vacate(self, cell):
+        self.occupancy[cell] -= 1
+        if self.occupancy[cell] == 0 and not self.fruit_grid[cell]:
+            self._give_free(cell)
 
     @property
     def stamina(self):
         a = self.gs ** 2
-        stamina = a + len(self.snake.tail) + 1
+        stamina = a + self.snake.tail_len + 1
         stamina = min(a * 2, stamina)
         return stamina
 
     def to_dict(self):
         return {
             'snake': self.snake.to_dict(),
-            'fruit': self.fruit_loc.to_dict()
+            'fruit': [f.to_dict() for f in self.fruit_locations],
+            'last_ate': self.last_ate,
         }
 
 
     def from_dict(self, d):
-        self.snake = Snake.from_dict(d['snake'])
-        self.fruit_location = Point.from_dict(d['fruit'])
+        self.snake = Snake.from_dict(d['snake'], grid_size=self.gs)
+        self.fruit_cells = [self._cell(Point.from_dict(f)) for f in d['fruit']]
+        self.last_ate = d.get('last_ate', 0)
+        self._rebuild_grid()
+        self._rehash()
+        self._invalidate_canvas()
+
+    def _grid_snapshot(self):
+        return (self.occupancy[:], self.fruit_grid[:], self.free_cells[:], self.free_index[:])
+
+    def _grid_restore(self, g):
+        self.occupancy, self.fruit_grid = g[0][:], g[1][:]
+        self.free_cells, self.free_index = g[2][:], g[3][:]
+
+    def snapshot(self, rng=True):
+        """
+        Copy of the whole game, plus the global random state unless rng is
+        False. restore can go back to the same snapshot any number of times.
+        """
+        snake = self.snake
+        return (
+            self._grid_snapshot(),
+            (snake.body[:], snake.body_dirs[:], snake.tail_start, snake.tail_len,
+             snake.tail_size, snake.dir_idx, snake.head_cell, snake._off_grid_head),
+            self.fruit_cells[:],
+            self.last_ate,
+            self.board_hash,
+            set(self.seen_hashes),
+            self.looped,
+            getstate() if rng else None,
+        )
+
+    def restore(self, snap):
+        grid, body, fruit_cells, self.last_ate, self.board_hash, seen, self.looped, rng = snap
+        self._grid_restore(grid)
+        snake = self.snake
+        snake.body, snake.body_dirs = body[0][:], body[1][:]
+        (snake.tail_start, snake.tail_len, snake.tail_size,
+         snake.dir_idx, snake.head_cell, snake._off_grid_head) = body[2:]
+        self.fruit_cells = fruit_cells[:]
+        self.seen_hashes = set(seen)
+        self._invalidate_canvas()
+        if rng is not None:
+            setstate(rng)
+
+    def clone(self):
+        # independent copy sharing only the immutable per grid size tables,
+        # the global random state is left alone
+        env = copy.copy(self)
+        env.snake = copy.copy(self.snake)
+        env._canvas = None
+        env.restore(self.snapshot(rng=False))
+        return env
+
+    def to_bytes(self, rng=True):
+        """
+        Compact binary form of the game for sending between processes, see
+        from_bytes. The loop detection history is not included.
+        """
+        snake = self.snake
+        n = snake.tail_len
+        head = snake.head
+        rng_state = getstate() if rng else None
+        out = [
+            _STATE_HEADER.pack(self.gs, snake.head_cell, head.x, head.y, snake.dir_idx,
+                               snake.tail_size, self.last_ate, n, len(self.fruit_cells),
+                               rng_state is not None),
+            array('h', snake.tail_cells()).tobytes(),
+            array('b', (snake.tail_dir(i) for i in reversed(range(n)))).tobytes(),
+            array('h', self.fruit_cells).tobytes(),
+        ]
+        if rng_state is not None:
+            version, mt, gauss_next = rng_state
+            out.append(_RNG_HEADER.pack(version, gauss_next is not None, gauss_next or 0.0))
+            out.append(array('I', mt).tobytes())
+        return b''.join(out)
+
+    def from_bytes(self, data):
+        (gs, head_cell, hx, hy, dir_idx, tail_size, last_ate, n, num_fruit_cells,
+         has_rng) = _STATE_HEADER.unpack_from(data)
+        assert gs == self.gs, f"state is for a {gs}x{gs} grid, env is {self.gs}x{self.gs}"
+        offset = _STATE_HEADER.size
+
+        def take(typecode, count):
+            nonlocal offset
+            a = array(typecode)
+            a.frombytes(data[offset:offset + a.itemsize * count])
+            offset += a.itemsize * count
+            return a
+
+        cells, dirs, fruit_cells = take('h', n), take('b', n), take('h', num_fruit_cells)
+
+        snake = Snake(grid_size=gs)
+        snake.head = Point(hx, hy)
+        snake.dir_idx = dir_idx
+        snake.tail_size = tail_size
+        for c, d in zip(cells, dirs):
+            snake.push_tail(c, d)
+        self.snake = snake
+        self.fruit_cells = list(fruit_cells)
+        self.last_ate = last_ate
+        self._rebuild_grid()
+        self._rehash()
+        self._invalidate_canvas()
+        self.looped = False
+
+        if has_rng:
+            version, has_gauss, gauss_next = _RNG_HEADER.unpack_from(data, offset)
+            offset += _RNG_HEADER.size
+            mt = take('I', (len(data) - offset) // 4)
+            setstate((version, tuple(mt), gauss_next if has_gauss else None))
 
 
     def update(self, direction=None):
+        self.step += 1
         self.last_ate += 1
         snake = self.snake
         self.snake.apply_direction(direction)
         self.snake.update()
+        head = snake.head_cell
         out_enum = SnakeState.OK
-
-        if snake.head in self.fruit_locations:
-            self.fruit_locations.pop(self.fruit_locations.index(snake.head))
+        if self.detect_loops:
+            self._hash_move()
+
+        if head >= 0:
+            self._occupy(head)
+        if head >= 0 and self.fruit_grid[head]:
+            self.fruit_cells.remove(head)
+            self.fruit_grid[head] = 0
+            if self.detect_loops:
+                self.board_hash ^= _zobrist_keys(self.gs)[2][head]
             self.last_ate = 0
             try:
                 self.set_fruits()
@@ -144,100 +474,269 @@ class Env:
                 out_enum = SnakeState.ATE
             except IndexError:
                 out_enum = SnakeState.WON
-            if len(self.fruit_locations) == 0:
+            if len(self.fruit_cells) == 0:
                 out_enum = SnakeState.WON
-        self.snake.shed()
-        if not self._bounds_check(snake.head) or self.snake.self_collision():
+
+        while snake.tail_len > max(0, snake.tail_size):
+            if self.detect_loops:
+                self._hash_shed()
+            cell = snake.pop_tail()
+            if cell >= 0:
+                self._vacate(cell)
+
+        if head < 0 or self.occupancy[head] > 1:
             out_enum = SnakeState.DED
         elif self.last_ate > self.stamina:
             out_enum = SnakeState.DED
 
+        if self.detect_loops:
+            out_enum = self._check_loop(out_enum)
+
         return out_enum
 
+    @property
+    def fruit_locations(self):
+        return [self.pos_list[c] for c in self.fruit_cells]
+
+    @fruit_locations.setter
+    def fruit_locations(self, points):
+        self.fruit_cells = [self._cell(p) for p in points]
+        self._rebuild_grid()
+        self._rehash()
+        self._invalidate_canvas()
+
     @property
     def fruit_loc(self):
         return self.fruit_locations
 
     def set_fruits(self):
-        snake = self.snake
-        snake_locs = set([snake.head] + snake.tail + self.fruit_locations)
-        possible_positions = self.pos_set.difference(snake_locs)
-        diff = self.num_fruits - len(self.fruit_locations)
-        new_locs = sample(list(possible_positions), k=min(diff, len(possible_positions)))
-        self.fruit_locations.extend(new_locs)
+        free = self.free_cells
+        diff = self.num_fruits - len(self.fruit_cells)
+        for _ in range(min(diff, len(free))):
+            cell = free[randrange(len(free))]
+            self._take_free(cell)
+            self.fruit_grid[cell] = 1
+            self.fruit_cells.append(cell)
+            if self.detect_loops:
+                self.board_hash ^= _zobrist_keys(self.gs)[2][cell]
 
     def _bounds_check(self, pos):
         return pos.x >= 0 and pos.x < self.gs and pos.y >= 0 and pos.y < self.gs
 
-    def to_image(self, gradation=True):
-        snake = self.snake
-        fl = self.fruit_loc
-        scale = 8
-
-        full_canvas = np.zeros((self.main_gs*scale, self.main_gs*scale), 'uint8')
-        h, w = self.gs*8, self.gs*8
-        canvas = full_canvas[self.subgrid_loc.y*scale:self.subgrid_loc.y*scale+h,
-                             self.subgrid_loc.x*scale:self.subgrid_loc.x*scale+w]
-        canvas += 64
-
-        def apply_rotation(im, angle):
-            return _rotate_image(im, angle)
-
-        def draw_sprite(canvas, y, x, stype, scale=8, rotation=0):
-            s = scale
-            canvas[y*s:(y+1)*s, x*s:(x+1)*s] = apply_rotation(sprites[stype], rotation)
-
-        for f in fl:
-            draw_sprite(canvas, f.y, f.x, 'fruit')
-
-        if self._bounds_check(snake.head):
-            draw_sprite(canvas, snake.head.y, snake.head.x, 'head',
-                        rotation=dir_map_to_angle[self.snake.direction])
-
-        limbs = [snake.head] + list(reversed(snake.tail))
-        for nxt, curr, prev in zip(limbs, limbs[1:], limbs[2:]):
-            d2 = curr - prev
-            d1 = nxt - curr
-            if d1 == d2:
-                draw_sprite(canvas, curr.y, curr.x, 'body',
-                            rotation=dir_map_to_angle[d2])
-                continue
-
-            rotation = None
-
-            d2 = curr - prev
-            d1 = nxt - curr
-
-            if (d1.x > 0 and d2.y < 0) or (d1.y > 0 and d2.x < 0):
-                rotation = 0
-            elif (d1.y > 0 and d2.x > 0) or (d1.x < 0 and d2.y < 0):
-                rotation = -90
-            elif (d1.x > 0 and d2.y > 0) or (d1.y < 0 and d2.x < 0):
-                rotation = 90
-            elif (d1.y < 0 and d2.x > 0) or (d1.x < 0 and d2.y > 0):
-                rotation = 180
+    def _cell_rect(self, cell):
+        y, x = divmod(cell, self.gs)
+        b = self._bounds
+        y += self.subgrid_loc.y
+        x += self.subgrid_loc.x
+        return b[y], b[y + 1], b[x], b[x + 1]
+
+    def _draw_sprite(self, cell, stype, rotation=0):
+        y0, y1, x0, x1 = self._cell_rect(cell)
+        self._canvas[y0:y1, x0:x1] = self._sprites[(y1 - y0, x1 - x0)][stype][rotation]
+
+    def _clear_cell(self, cell):
+        y0, y1, x0, x1 = self._cell_rect(cell)
+        self._canvas[y0:y1, x0:x1] = 64
 
+    def _draw_segment(self, k):
+        # body segment k counted from the neck, d1 is the direction it was
+        # left in and d2 the one it was entered in
+        snake = self.snake
+        curr, d1 = snake.tail_cell(k), snake.tail_dir(k)
+        if k == snake.tail_len - 1:
+            self._draw_sprite(curr, 'tail', rotation=_dir_angles[d1])
+            return
+        d2 = snake.tail_dir(k + 1)
+        if d1 == d2:
+            self._draw_sprite(curr, 'body', rotation=_dir_angles[d2])
+        else:
+            rotation = _turn_angles[d1][d2]
             if rotation is not None:
-                draw_sprite(canvas, curr.y, curr.x, 'turn',
-                            rotation=rotation)
+                self._draw_sprite(curr, 'turn', rotation=rotation)
+
+    def _head_hit(self):
+        return self.occupancy[self.snake.head_cell] > 1
 
-        if len(limbs) > 1:
-            draw_sprite(canvas, limbs[-1].y, limbs[-1].x, 'tail', rotation=dir_map_to_angle[limbs[-2]-limbs[-1]])
+    def _redraw(self):
+        b = self._bounds
+        size = b[-1]
+        if self._canvas is None or self._canvas.shape != (size, size):
+            self._canvas = np.zeros((size, size), 'uint8')
+        self._canvas[:] = 0
+        y, x = self.subgrid_loc.y, self.subgrid_loc.x
+        self._canvas[b[y]:b[y + self.gs], b[x]:b[x + self.gs]] = 64
+
+        for f in self.fruit_cells:
+            self._draw_sprite(f, 'fruit')
+
+        snake = self.snake
+        if snake.head_cell >= 0:
+            self._draw_sprite(snake.head_cell, 'head', rotation=_dir_angles[snake.dir_idx])
 
-        return full_canvas
+        for k in range(snake.tail_len):
+            self._draw_segment(k)
+
+    def _redraw_dirty(self):
+        # one update since the last frame: only the old and new head, tail
+        # tip and fruits can have changed, the rest of the body kept its
+        # sprite. Drawn in the same order as _redraw
+        snake = self.snake
+        n = snake.tail_len
+        cells = self._canvas_cells
+        dirty = set(cells)
+        dirty.update(self.fruit_cells)
+        dirty.add(snake.head_cell)
+        if n:
+            dirty.add(snake.tail_cell(0))
+            dirty.add(snake.tail_cell(n - 1))
+        dirty.discard(-1)
+        for c in dirty:
+            self._clear_cell(c)
+
+        for f in self.fruit_cells:
+            self._draw_sprite(f, 'fruit')
+        self._draw_sprite(snake.head_cell, 'head', rotation=_dir_angles[snake.dir_idx])
+        if n:
+            self._draw_segment(0)
+        if n > 1:
+            self._draw_segment(n - 1)
+
+    def to_grid(self, out=None):
+        """
+        Symbolic [GRID_CHANNELS, gs, gs] uint8 view of the board: head, body
+        (255 at the neck fading towards the tail tip), fruit, then one plane
+        per direction in action_dir_order, the heading one filled with 255.
+        """
+        gs = self.gs
+        if out is None:
+            out = np.zeros((GRID_CHANNELS, gs, gs), dtype=np.uint8)
+        else:
+            out[:] = 0
+        flat = out.reshape(GRID_CHANNELS, gs * gs)
+        snake = self.snake
+        if snake.head_cell >= 0:
+            flat[GRID_HEAD, snake.head_cell] = 255
+        n = snake.tail_len
+        if n:
+            cells = np.fromiter(snake.tail_cells(), dtype=np.intp, count=n)
+            age = (np.arange(1, n + 1) * 255) // n
+            on_grid = cells >= 0
+            flat[GRID_BODY, cells[on_grid]] = age[on_grid]
+        flat[GRID_FRUIT, self.fruit_cells] = 255
+        out[GRID_DIRECTION + snake.dir_idx] = 255
+        return out
+
+    def to_image(self, gradation=True, copy=True):
+        """
+        Render the board. The canvas is kept between calls and redrawn in
+        full only after a reset, restore or anything other than a single
+        update since the last call. copy=False returns the canvas itself,
+        which the next call draws over.
+        """
+        snake = self.snake
+        if self._canvas_step != self.step:
+            incremental = (self._canvas is not None and self._canvas_snake is snake
+                           and self._canvas_step == self.step - 1
+                           and snake.head_cell >= 0 and not self._head_hit())
+            if incremental:
+                self._redraw_dirty()
+            else:
+                self._redraw()
+            self._canvas_snake = snake
+            self._canvas_step = self.step
+            n = snake.tail_len
+            self._canvas_cells = [snake.head_cell, snake.tail_cell(n - 1) if n else -1] + self.fruit_cells
+
+        return self._canvas.copy() if copy else self._canvas
 
 INIT_TAIL_SIZE = 4
+
+# planes of Env.to_grid, the direction planes follow action_dir_order
+GRID_HEAD = 0
+GRID_BODY = 1
+GRID_FRUIT = 2
+GRID_DIRECTION = 3
+GRID_CHANNELS = GRID_DIRECTION + len(action_dir_order)
+
 class Snake:
-    def __init__(self, x: int = 0, y: int = 0):
-        self.head = Point(x, y)
-        self.tail = []
+    def __init__(self, x: int = 0, y: int = 0, grid_size: int = 10):
+        self.gs = grid_size
+        self.points = _grid_points(grid_size)
+        self.neighbours = _neighbours(grid_size)
+        # tail as cell ids in a circular buffer, oldest segment at tail_start,
+        # body_dirs holds the direction each segment was left in
+        self.body = [0] * (grid_size * grid_size)
+        self.body_dirs = [0] * (grid_size * grid_size)
+        self.tail_start = 0
+        self.tail_len = 0
         self.tail_size = INIT_TAIL_SIZE
-        self.direction = Point(1, 0)  # Need to add validation later
         self.dir_idx = 0
+        self.head = Point(x, y)
+
+    @property
+    def head(self):
+        if self.head_cell >= 0:
+            return self.points[self.head_cell]
+        return self._off_grid_head
+
+    @head.setter
+    def head(self, p):
+        # head_cell is -1 once the snake has left the grid
+        in_bounds = 0 <= p.x < self.gs and 0 <= p.y < self.gs
+        self.head_cell = p.y * self.gs + p.x if in_bounds else -1
+        self._off_grid_head = p
+
+    @property
+    def direction(self):
+        return _dir_points[self.dir_idx]
+
+    @direction.setter
+    def direction(self, p):
+        self.dir_idx = _dir_points.index(p)
+
+    @property
+    def tail(self):
+        return [self.points[c] for c in self.tail_cells()]
+
+    @tail.setter
+    def tail(self, points):
+        self.tail_start = 0
+        self.tail_len = 0
+        for p, nxt in zip(points, list(points[1:]) + [self.head]):
+            d = nxt - p
+            self.push_tail(p.y * self.gs + p.x, _dir_points.index(d) if d in _dir_points else 0)
+
+    def tail_cells(self):
+        # oldest first, same order as the old tail list
+        cap = len(self.body)
+        for i in range(self.tail_len):
+            yield self.body[(self.tail_start + i) % cap]
+
+    def tail_cell(self, i):
+        # i-th segment counting back from the neck
+        return self.body[(self.tail_start + self.tail_len - 1 - i) % len(self.body)]
+
+    def tail_dir(self, i):
+        return self.body_dirs[(self.tail_start + self.tail_len - 1 - i) % len(self.body)]
+
+    def push_tail(self, cell, direction):
+        cap = len(self.body)
+        if self.tail_len == cap:
+            self.pop_tail()
+        i = (self.tail_start + self.tail_len) % cap
+        self.body[i] = cell
+        self.body_dirs[i] = direction
+        self.tail_len += 1
+
+    def pop_tail(self):
+        cell = self.body[self.tail_start]
+        self.tail_start = (self.tail_start + 1) % len(self.body)
+        self.tail_len -= 1
+        return cell
 
     def self_collision(self):
-        for t in self.tail:
-            if self.head.x == t.x and self.head.y == t.y:
+        for t in self.tail_cells():
+            if t == self.head_cell:
                 return True
         return False
 
@@ -250,8 +749,8 @@ class Snake:
         }
 
     @classmethod
-    def from_dict(cls, d):
-        s = cls()
+    def from_dict(cls, d, grid_size=10):
+        s = cls(grid_size=grid_size)
         s.head = Point.from_dict(d['head'])
         s.tail = [Point.from_dict(t) for t in d['tail']]
         s.tail_size = d['tail_size']
@@ -259,16 +758,17 @@ class Snake:
         return s
 
     def update(self):
-        new_head = self.head.copy(self.direction.x, self.direction.y)
-
-        self.tail.append(self.head)  # OK direction? or do I need to add this to the top?
-        self.head = new_head
+        cell = self.head_cell
+        self.push_tail(cell, self.dir_idx)
+        new_cell = self.neighbours[self.dir_idx][cell] if cell >= 0 else -1
+        if new_cell < 0:
+            d = self.direction
+            self._off_grid_head = self.head.copy(d.x, d.y)
+        self.head_cell = new_cell
 
     def shed(self):
-        if self.tail_size > 0:
-            self.tail = self.tail[-self.tail_size:]
-        else:
-            self.tail = []
+        while self.tail_len > max(0, self.tail_size):
+            self.pop_tail()
 
     def __repr__(self):
         return f"""Head: {self.head}
@@ -288,10 +788,159 @@ class Snake:
     def apply_direction(self, new_dir=None):
         if not new_dir:
             return
-        assert new_dir in action_dir_map, f"Unknown direction {new_dir}"
+        assert new_dir in _dir_ids, f"Unknown direction {new_dir}"
+
+        self.dir_idx = _dir_ids[new_dir]
+
+
+def _popcount(m):
+    return bin(m).count('1')
 
-        self.direction = action_dir_map[new_dir]
 
+def _nth_set_bit(m, n):
+    # index of the n-th (0 based) set bit of a 64 bit mask, by halving
+    pos = 0
+    width = 32
+    while width:
+        low = m & ((1 << width) - 1)
+        c = _popcount(low)
+        if n < c:
+            m = low
+        else:
+            n -= c
+            m >>= width
+            pos += width
+        width >>= 1
+    return pos
+
+
+class BitboardEnv(Env):
+    """
+    Env for boards of up to 8x8, where the snake and the fruits are each one
+    bit per cell of a 64 bit int. Occupancy, fruit placement, collision and
+    bounds checks are bit operations, the Snake ring buffer still keeps the
+    body order so rendering is unchanged.
+    """
+
+    def __init__(self, grid_size=4, main_gs=4, num_fruits=1, detect_loops=False, loop_state=None,
+                 scale=8, image_size=None):
+        assert grid_size * grid_size <= 64, "bitboards only fit grids up to 8x8"
+        gs = grid_size
+        self.full_mask = (1 << (gs * gs)) - 1
+        left_col = sum(1 << (y * gs) for y in range(gs))
+        top_row = (1 << gs) - 1
+        # indexed like action_dir_order: right, up, left, down
+        self.edge_masks = (
+            left_col << (gs - 1),
+            top_row,
+            left_col,
+            top_row << (gs * (gs - 1)),
+        )
+        self.shifts = (1, -gs, -1, gs)
+        super(BitboardEnv, self).__init__(grid_size, main_gs=main_gs, num_fruits=num_fruits,
+                                          detect_loops=detect_loops, loop_state=loop_state,
+                                          scale=scale, image_size=image_size)
+
+    def _rebuild_grid(self):
+        self.snake_bits = 0
+        self.fruit_bits = 0
+        if self.snake.head_cell >= 0:
+            self.snake_bits |= 1 << self.snake.head_cell
+        for c in self.snake.tail_cells():
+            if c >= 0:
+                self.snake_bits |= 1 << c
+        for c in self.fruit_cells:
+            self.fruit_bits |= 1 << c
+
+    def _grid_snapshot(self):
+        return self.snake_bits, self.fruit_bits
+
+    def _grid_restore(self, g):
+        self.snake_bits, self.fruit_bits = g
+
+    def update(self, direction=None):
+        self.step += 1
+        self.last_ate += 1
+        snake = self.snake
+        snake.apply_direction(direction)
+        d = snake.dir_idx
+        head = snake.head_cell
+
+        if head < 0 or (1 << head) & self.edge_masks[d]:
+            snake.update()
+            if self.detect_loops:
+                self._hash_move()
+            self._shed()
+            return SnakeState.DED
+
+        snake.push_tail(head, d)
+        head += self.shifts[d]
+        snake.head_cell = head
+        bit = 1 << head
+        hit = self.snake_bits & bit
+        self.snake_bits |= bit
+        out_enum = SnakeState.OK
+        if self.detect_loops:
+            self._hash_move()
+
+        if self.fruit_bits & bit:
+            self.fruit_bits ^= bit
+            self.fruit_cells.remove(head)
+            if self.detect_loops:
+                self.board_hash ^= _zobrist_keys(self.gs)[2][head]
+            self.last_ate = 0
+            self.set_fruits()
+            snake.tail_size += 1
+            out_enum = SnakeState.ATE
+            if not self.fruit_cells:
+                out_enum = SnakeState.WON
+
+        while snake.tail_len > snake.tail_size:
+            if self.detect_loops:
+                self._hash_shed()
+            tip = snake.pop_tail()
+            if tip == head:
+                # moved onto the tail tip as it left, not a collision
+                hit = 0
+            else:
+                self.snake_bits &= ~(1 << tip)
+
+        if hit:
+            out_enum = SnakeState.DED
+        elif self.last_ate > self.stamina:
+            out_enum = SnakeState.DED
+
+        if self.detect_loops:
+            out_enum = self._check_loop(out_enum)
+
+        return out_enum
+
+    def _head_hit(self):
+        # the head shares its bit with a body segment after a collision
+        return _popcount(self.snake_bits) <= self.snake.tail_len
+
+    def _shed(self):
+        snake = self.snake
+        cell = -1
+        while snake.tail_len > max(0, snake.tail_size):
+            if self.detect_loops:
+                self._hash_shed()
+            cell = snake.pop_tail()
+            if cell >= 0 and cell != snake.head_cell:
+                self.snake_bits &= ~(1 << cell)
+        return cell
+
+    def set_fruits(self):
+        free = self.full_mask & ~(self.snake_bits | self.fruit_bits)
+        for _ in range(self.num_fruits - len(self.fruit_cells)):
+            if not free:
+                break
+            cell = _nth_set_bit(free, randrange(_popcount(free)))
+            free ^= 1 << cell
+            self.fruit_bits |= 1 << cell
+            self.fruit_cells.append(cell)
+            if self.detect_loops:
+                self.board_hash ^= _zobrist_keys(self.gs)[2][cell]
 
 if __name__ == '__main__':
     import cv2
@@ -0,0 +1,227 @@
+import numpy as np
+from snake import SnakeState, INIT_TAIL_SIZE, action_dir_order, reward_map
+from snake_render import TILE_FRUIT, TILE_HEAD, TILE_BODY, TILE_TURN, TILE_TAIL, DIR_ROTATIONS, TURN_ROTATIONS
+
+# indexed the same way as action_dir_order: right, up, left, down
+DIR_DX = np.array([1, 0, -1, 0], dtype=np.int64)
+DIR_DY = np.array([0, -1, 0, 1], dtype=np.int64)
+
+EMPTY = 0
+FRUIT = 1
+BODY = 2
+HEAD = 3
+
+_OK = SnakeState.OK.value
+_ATE = SnakeState.ATE.value
+_DED = SnakeState.DED.value
+_WON = SnakeState.WON.value
+
+
+class BatchedSnakeEnv:
+    """
+    N snake games stepped together. Every board lives in shared numpy arrays
+    and follows the same rules as snake.Env.update, finished boards are reset
+    automatically at the end of step.
+    """
+
+    def __init__(self, num_envs, gs=10, num_fruits=1, action_map=None, seed=None):
+        self.num_envs = num_envs
+        self.gs = gs
+        self.num_cells = gs * gs
+        self.num_fruits = num_fruits
+        self.action_map = {
+            0: 'up',
+            1: 'down',
+            2: 'left',
+            3: 'right'
+        }
+        if action_map is not None:
+            self.action_map = action_map
+
+        # action index -> direction index, -1 keeps the current direction
+        self.action_to_dir = np.array([
+            action_dir_order.index(self.action_map[a]) if self.action_map[a] else -1
+            for a in sorted(self.action_map.keys())
+        ], dtype=np.int64)
+
+        self.reward_table = np.zeros(len(SnakeState) + 1, dtype=np.float32)
+        for k, v in reward_map.items():
+            self.reward_table[k.value] = v
+
+        self.rng = np.random.default_rng(seed)
+        self.rows = np.arange(num_envs)
+
+        n, a = num_envs, self.num_cells
+        self.head_x = np.zeros(n, dtype=np.int64)
+        self.head_y = np.zeros(n, dtype=np.int64)
+        self.direction = np.zeros(n, dtype=np.int64)
+        # ring buffer of tail cells (y*gs+x), oldest first starting at body_start
+        self.body = np.zeros((n, a), dtype=np.int64)
+        self.body_start = np.zeros(n, dtype=np.int64)
+        self.body_len = np.zeros(n, dtype=np.int64)
+        self.tail_size = np.zeros(n, dtype=np.int64)
+        self.occupied = np.zeros((n, a), dtype=bool)
+        self.fruits = np.zeros((n, a), dtype=bool)
+        self.num_fruit_left = np.zeros(n, dtype=np.int64)
+        self.last_ate = np.zeros(n, dtype=np.int64)
+        self.steps = np.zeros(n, dtype=np.int64)
+
+        self.reset()
+
+    def reset(self, mask=None):
+        if mask is None:
+            mask = np.ones(self.num_envs, dtype=bool)
+        idx = self.rows[mask]
+        if len(idx) == 0:
+            return self.observe()
+
+        self.head_x[idx] = self.gs // 2
+        self.head_y[idx] = self.gs // 2
+        self.direction[idx] = 0
+        self.body_start[idx] = 0
+        self.body_len[idx] = 0
+        self.tail_size[idx] = INIT_TAIL_SIZE
+        self.occupied[idx] = False
+        self.fruits[idx] = False
+        self.num_fruit_left[idx] = 0
+        self.last_ate[idx] = 0
+        self.steps[idx] = 0
+
+        self._set_fruits(idx, self.head_y[idx] * self.gs + self.head_x[idx])
+        return self.observe()
+
+    @property
+    def stamina(self):
+        a = self.num_cells
+        return np.minimum(a * 2, a + self.body_len + 1)
+
+    @property
+    def head(self):
+        return self.head_y * self.gs + self.head_x
+
+    def _set_fruits(self, idx, head_cells):
+        # mirrors Env.set_fruits: top every board in idx back up to num_fruits
+        # with cells that are not covered by the snake or another fruit
+        while len(idx):
+            missing = self.num_fruits - self.num_fruit_left[idx]
+            free = ~(self.occupied[idx] | self.fruits[idx])
+            free[np.arange(len(idx)), head_cells] = False
+            can_place = (missing > 0) & free.any(1)
+            if not can_place.any():
+                return
+            idx, head_cells, free = idx[can_place], head_cells[can_place], free[can_place]
+            # uniform choice over the free cells of each board
+            cells = np.where(free, self.rng.random(free.shape), -1.0).argmax(1)
+            self.fruits[idx, cells] = True
+            self.num_fruit_left[idx] += 1
+
+    def step(self, actions):
+        rows = self.rows
+        gs = self.gs
+        cap = self.num_cells
+
+        dirs = self.action_to_dir[np.asarray(actions, dtype=np.int64)]
+        self.direction = np.where(dirs >= 0, dirs, self.direction)
+        self.last_ate += 1
+        self.steps += 1
+
+        # old head becomes the newest tail segment
+        old_head = self.head
+        self.body[rows, (self.body_start + self.body_len) % cap] = old_head
+        self.occupied[rows, old_head] = True
+        self.body_len += 1
+
+        nx = self.head_x + DIR_DX[self.direction]
+        ny = self.head_y + DIR_DY[self.direction]
+        in_bounds = (nx >= 0) & (nx < gs) & (ny >= 0) & (ny < gs)
+        new_head = np.where(in_bounds, ny * gs + nx, 0)
+
+        out = np.full(self.num_envs, _OK, dtype=np.int8)
+
+        ate = in_bounds & self.fruits[rows, new_head]
+        if ate.any():
+            ate_idx = rows[ate]
+            self.fruits[ate_idx, new_head[ate]] = False
+            self.num_fruit_left[ate_idx] -= 1
+            self.last_ate[ate_idx] = 0
+            self.tail_size[ate_idx] += 1
+            self._set_fruits(ate_idx, new_head[ate])
+            out[ate] = _ATE
+            out[ate & (self.num_fruit_left == 0)] = _WON
+
+        # shed: the tail grows by at most one segment per step
+        shed = self.body_len > self.tail_size
+        if shed.any():
+            shed_idx = rows[shed]
+            tip = self.body[shed_idx, self.body_start[shed_idx]]
+            self.occupied[shed_idx, tip] = False
+            self.body_start[shed_idx] = (self.body_start[shed_idx] + 1) % cap
+            self.body_len[shed_idx] -= 1
+
+        dead = ~in_bounds | self.occupied[rows, new_head]
+        dead |= self.last_ate > self.stamina
+        out[dead] = _DED
+
+        self.head_x = nx
+        self.head_y = ny
+
+        rewards = self.reward_table[out]
+        dones = (out == _DED) | (out == _WON)
+        info = {
+            'state': out,
+            'score': np.where(dones, self.body_len - INIT_TAIL_SIZE, 0),
+        }
+
+        if dones.any():
+            self.reset(dones)
+
+        return self.observe(), rewards, dones, info
+
+    def tail_cells(self, i):
+        """tail of board i, oldest segment first, same order as Snake.tail"""
+        idx = (self.body_start[i] + np.arange(self.body_len[i])) % self.num_cells
+        return self.body[i, idx]
+
+    def tiles(self):
+        """
+        [N, gs, gs] tile and rotation ids of every board for
+        snake_render.TileRenderer, drawn the same way as Env.to_image
+        """
+        n, a, gs = self.num_envs, self.num_cells, self.gs
+        rows = self.rows
+        tiles = np.zeros((n, a), dtype=np.uint8)
+        rotations = np.zeros((n, a), dtype=np.uint8)
+        tiles[self.fruits] = TILE_FRUIT
+        head = self.head
+        tiles[rows, head] = TILE_HEAD
+        rotations[rows, head] = DIR_ROTATIONS[self.direction]
+
+        # body oldest first, each segment is left towards the next one (or
+        # the head) and entered from the one before it
+        k = np.arange(a)
+        valid = k < self.body_len[:, None]
+        cells = self.body[rows[:, None], (self.body_start[:, None] + k) % a]
+        nxt = np.where(k + 1 < self.body_len[:, None], np.roll(cells, -1, 1), head[:, None])
+        # cell step -> direction index, +1 right, -gs up, -1 left, +gs down
+        step_dirs = np.zeros(2 * gs + 1, dtype=np.int64)
+        step_dirs[[gs + 1, 0, gs - 1, 2 * gs]] = [0, 1, 2, 3]
+        leave = step_dirs[np.clip(nxt - cells + gs, 0, 2 * gs)]
+        enter = np.roll(leave, 1, 1)
+
+        tip = valid & (k == 0)
+        straight = valid & (k > 0) & (leave == enter)
+        turn_rot = TURN_ROTATIONS[leave, enter]
+        turn = valid & (k > 0) & (leave != enter) & (turn_rot >= 0)
+        for mask, tile, rot in [(turn, TILE_TURN, turn_rot), (straight, TILE_BODY, DIR_ROTATIONS[enter]),
+                                (tip, TILE_TAIL, DIR_ROTATIONS[leave])]:
+            r, c = np.nonzero(mask)
+            tiles[r, cells[r, c]] = tile
+            rotations[r, cells[r, c]] = rot[r, c]
+        return tiles.reshape(n, gs, gs), rotations.reshape(n, gs, gs)
+
+    def observe(self):
+        grid = np.zeros((self.num_envs, self.num_cells), dtype=np.uint8)
+        grid[self.fruits] = FRUIT
+        grid[self.occupied] = BODY
+        grid[self.rows, self.head] = HEAD
+        return grid.reshape(self.num_envs, self.gs, self.gs)
@@ -0,0 +1,327 @@
+import os
+import glob
+from collections import deque
+from multiprocessing import Pool
+from random import getstate, setstate, seed
+import numpy as np
+import argh
+from snake import Env, SnakeState, action_dir_order
+
+default_action_map = {
+    0: 'up',
+    1: 'down',
+    2: 'left',
+    3: 'right'
+}
+
+
+def _hamiltonian_cycle(gs):
+    # direction to take from every cell to follow a cycle through the whole
+    # board: zig-zag rows over columns 1.. and come back up column 0, only
+    # exists for an even grid size
+    if gs % 2:
+        return None
+    right, up, left, down = range(4)
+    nxt = [0] * (gs * gs)
+    for y in range(gs):
+        for x in range(gs):
+            if x == 0:
+                d = up if y > 0 else right
+            elif y % 2 == 0:
+                d = right if x < gs - 1 else down
+            elif x > 1:
+                d = left
+            else:
+                d = down if y < gs - 1 else left
+            nxt[y * gs + x] = d
+    return nxt
+
+
+class SnakeExpert:
+    """
+    Scripted snake.Env player. It follows the shortest path to a fruit when,
+    after eating it, the head can still reach the tail. Otherwise it falls
+    back to a Hamiltonian cycle and, failing that, to the move that keeps
+    the largest reachable area. act returns a direction name.
+    """
+
+    def __init__(self, gs):
+        self.gs = gs
+        self.cycle = _hamiltonian_cycle(gs)
+        self.path = deque()
+
+    def reset(self):
+        self.path.clear()
+
+    def _blocked(self, env):
+        # tail tip is left free since it moves out of the way on the next step
+        blocked = bytearray(self.gs * self.gs)
+        snake = env.snake
+        for c in snake.tail_cells():
+            blocked[c] = 1
+        if snake.tail_len and snake.tail_len >= snake.tail_size:
+            blocked[snake.tail_cell(snake.tail_len - 1)] = 0
+        return blocked
+
+    def _bfs(self, env, blocked, goals):
+        # shortest list of directions from the head to any cell in goals
+        nb = env.snake.neighbours
+        start = env.snake.head_cell
+        parent = {start: None}
+        q = deque([start])
+        while q:
+            c = q.popleft()
+            if c in goals:
+                path = []
+                while parent[c] is not None:
+                    c, d = parent[c]
+                    path.append(d)
+                return path[::-1]
+            for d in range(4):
+                n = nb[d][c]
+                if n >= 0 and not blocked[n] and n not in parent:
+                    parent[n] = (c, d)
+                    q.append(n)
+        return None
+
+    def _reachable(self, env, blocked):
+        nb = env.snake.neighbours
+        seen = {env.snake.head_cell}
+        q = [env.snake.head_cell]
+        while q:
+            c = q.pop()
+            for d in range(4):
+                n = nb[d][c]
+                if n >= 0 and not blocked[n] and n not in seen:
+                    seen.add(n)
+                    q.append(n)
+        return len(seen)
+
+    def _tail_reachable(self, env):
+        snake = env.snake
+        if snake.tail_len == 0:
+            return True
+        tip = snake.tail_cell(snake.tail_len - 1)
+        blocked = self._blocked(env)
+        blocked[tip] = 0
+        return self._bfs(env, blocked, {tip}) is not None
+
+    def _simulate(self, env, path):
+        # play path out on a copy, the global random state is put back after
+        # any fruit spawns on the copy
+        rng = getstate()
+        sim = env.clone()
+        enum = SnakeState.OK
+        for d in path:
+            enum = sim.update(action_dir_order[d])
+            if enum in [SnakeState.DED, SnakeState.WON]:
+                break
+        setstate(rng)
+        return sim, enum
+
+    def _safe(self, env, path):
+        sim, enum = self._simulate(env, path)
+        return enum is SnakeState.WON or (enum is not SnakeState.DED and self._tail_reachable(sim))
+
+    def _fallback(self, env):
+        snake = env.snake
+        if self.cycle is not None:
+            d = self.cycle[snake.head_cell]
+            if self._safe(env, [d]):
+                return d
+
+        best, best_score = snake.dir_idx, None
+        for d in range(4):
+            sim, enum = self._simulate(env, [d])
+            if enum is SnakeState.DED:
+                continue
+            score = (self._tail_reachable(sim), self._reachable(sim, self._blocked(sim)))
+            if best_score is None or score > best_score:
+                best, best_score = d, score
+        return best
+
+    def act(self, env):
+        if not self.path:
+            path = self._bfs(env, self._blocked(env), set(env.fruit_cells))
+            if path and self._safe(env, path):
+                self.path.extend(path)
+        if self.path:
+            return action_dir_order[self.path.popleft()]
+        return action_dir_order[self._fallback(env)]
+
+
+def _record(args):
+    worker, path, num_frames, shard_frames, gs, main_gs, num_fruits, action_map, randseed = args
+    seed(randseed + worker)
+    action_ids = {v: k for k, v in action_map.items()}
+    env = Env(gs, main_gs=main_gs, num_fruits=num_fruits)
+    env.reset()
+    expert = SnakeExpert(gs)
+    h, w = env.to_image().shape
+
+    done_frames = 0
+    shard = 0
+    while done_frames < num_frames:
+        n = min(shard_frames, num_frames - done_frames)
+        obs = np.empty((n, h, w), dtype=np.uint8)
+        actions = np.empty(n, dtype=np.uint8)
+        for i in range(n):
+            direction = expert.act(env)
+            obs[i] = env.to_image(copy=False)
+            actions[i] = action_ids[direction]
+            enum = env.update(direction)
+            if enum in [SnakeState.DED, SnakeState.WON]:
+                env.reset()
+                expert.reset()
+        np.savez_compressed(os.path.join(path, f"demos_{worker:03d}_{shard:05d}.npz"),
+                            obs=obs, actions=actions, gs=gs, main_gs=main_gs)
+        done_frames += n
+        shard += 1
+    return done_frames
+
+
+def generate(path, num_frames=1000000, gs=20, main_gs=22, num_fruits=1, workers=os.cpu_count(),
+             shard_frames=50000, randseed=0, action_map=None):
+    """
+    Play the expert in parallel worker processes and write (observation,
+    action) pairs as compressed npz shards under path. Observations are the
+    uint8 Env.to_image frames, actions index action_map (SnakeEnv's default).
+    """
+    action_map = default_action_map if action_map is None else action_map
+    os.makedirs(path, exist_ok=True)
+    per_worker = -(-num_frames // workers)
+    jobs = [(w, path, min(per_worker, num_frames - w * per_worker), shard_frames, gs, main_gs,
+             num_fruits, action_map, randseed) for w in range(workers) if w * per_worker < num_frames]
+    with Pool(len(jobs)) as pool:
+        return sum(pool.map(_record, jobs))
+
+
+def load_demos(path):
+    """all shards under path as (obs [N, H, W] uint8, actions [N] int64)"""
+    obs, actions = [], []
+    for f in sorted(glob.glob(os.path.join(path, 'demos_*.npz'))):
+        with np.load(f) as d:
+            obs.append(d['obs'])
+            actions.append(d['actions'])
+    return np.concatenate(obs), np.concatenate(actions).astype(np.int64)
+
+
+def iterate_demos(demos, batch_size, shuffle=True):
+    obs, actions = demos
+    idx = np.random.permutation(len(obs)) if shuffle else np.arange(len(obs))
+    for i in range(0, len(idx), batch_size):
+        b = idx[i:i + batch_size]
+        yield obs[b], actions[b]
+
+
+def remap_demos(demos, action_map, demo_action_map=None):
+    """
+    demos with their actions as indices of action_map, the samples whose
+    direction it has no action for are dropped
+    """
+    obs, actions = demos
+    demo_action_map = default_action_map if demo_action_map is None else demo_action_map
+    ids = {d: a for a, d in action_map.items()}
+    table = np.full(max(demo_action_map) + 1, -1, dtype=np.int64)
+    for a, d in demo_action_map.items():
+        table[a] = ids.get(d, -1)
+    mapped = table[actions]
+    keep = mapped >= 0
+    return obs[keep], mapped[keep]
+
+
+def _check_frames(demos, shape):
+    if shape is not None and tuple(demos[0].shape[1:3]) != tuple(shape):
+        raise ValueError(f"demo frames are {demos[0].shape[1:3]} but the model takes {tuple(shape)}, "
+                         f"generate them with a main_gs that draws frames of that size (8 pixels per cell)")
+
+
+def pretrain_torch(model, demos, epochs=1, batch_size=256, lr=1e-4, stack=1, device='cpu', logits_fn=None,
+                   action_map=None, input_shape=None):
+    """
+    Behaviour cloning warm start for a torch policy such as snake_ptan.Net or
+    VisualAgentPPO. Frames go in as [N, stack, H, W] with the single demo
+    frame repeated stack times to fill a frame stack. The demo frames have to
+    be the model's input size, input_shape (H, W) checks it. action_map is
+    the model's, demos for directions it has no action for are dropped.
+    """
+    import torch
+    import torch.nn.functional as F
+
+    _check_frames(demos, input_shape)
+    if action_map is not None:
+        demos = remap_demos(demos, action_map)
+
+    if logits_fn is None:
+        if hasattr(model, '_recurrent'):
+            # VisualAgentPPO, every demo frame is treated as an episode start
+            logits_fn = lambda x: model(x, torch.zeros((x.shape[0], model._recurrent), device=device))[0].logits
+        else:
+            logits_fn = model
+    optimizer = getattr(model, 'optimizer', None) or torch.optim.Adam(model.parameters(), lr=lr)
+
+    model.train()
+    for epoch in range(epochs):
+        total_loss, correct, seen = 0.0, 0, 0
+        for obs, actions in iterate_demos(demos, batch_size):
+            x = torch.from_numpy(obs).to(device).unsqueeze(1).float()
+            if stack > 1:
+                x = x.expand(-1, stack, -1, -1)
+            y = torch.from_numpy(actions).to(device)
+            logits = logits_fn(x)
+            loss = F.cross_entropy(logits, y)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            total_loss += loss.item() * len(y)
+            correct += (logits.argmax(1) == y).sum().item()
+            seen += len(y)
+        print(f"bc epoch {epoch}: loss {total_loss / seen:.4f} acc {correct / seen:.3f}")
+    return model
+
+
+def pretrain_tf2(model, demos, epochs=1, batch_size=256, logits_fn=None, action_map=None):
+    """
+    Behaviour cloning warm start for the TF2 SnakeModels. Uses pcall (policy
+    logits) when the model has one, otherwise the Q values of the main model
+    are trained as logits, which ranks the expert action first for dqn_tf2.
+    The demo frames have to match model.image_shape. action_map is the
+    model's, by default the first num_actions of SnakeEnv's, and demos for
+    directions it has no action for are dropped (dqn_tf2 has no 'right').
+    """
+    import tensorflow as tf
+
+    shape = getattr(model, 'image_shape', None)
+    _check_frames(demos, None if shape is None else shape[:2])
+    channels = 1 if shape is None else shape[-1]
+    if action_map is None and hasattr(model, 'num_actions'):
+        action_map = {a: default_action_map[a] for a in range(model.num_actions)}
+    if action_map is not None:
+        demos = remap_demos(demos, action_map)
+
+    if logits_fn is None:
+        logits_fn = model.pcall if hasattr(model, 'pcall') else lambda x: model(x / 255)
+    loss_fn = tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True)
+
+    for epoch in range(epochs):
+        total_loss, correct, seen = 0.0, 0, 0
+        for obs, actions in iterate_demos(demos, batch_size):
+            x = tf.convert_to_tensor(np.repeat(obs[..., None], channels, -1), dtype=tf.float32)
+            with tf.GradientTape() as tape:
+                logits = logits_fn(x)
+                loss = loss_fn(actions, logits)
+            grads = tape.gradient(loss, model.trainable_variables)
+            model.optimizer.apply_gradients([(g, v) for g, v in zip(grads, model.trainable_variables) if g is not None])
+            total_loss += float(loss) * len(actions)
+            correct += int(np.sum(np.argmax(logits, 1) == actions))
+            seen += len(actions)
+        print(f"bc epoch {epoch}: loss {total_loss / seen:.4f} acc {correct / seen:.3f}")
+    return model
+
+
+def main(path, num_frames=1000000, gs=20, main_gs=22, num_fruits=1, workers=os.cpu_count(), shard_frames=50000):
+    print(f"wrote {generate(path, num_frames, gs, main_gs, num_fruits, workers, shard_frames)} frames to {path}")
+
+
+if __name__ == '__main__':
+    argh.dispatch_command(main)
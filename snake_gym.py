@@ -6,7 +6,8 @@ from gym.utils import play
 from gym import spaces
 from gym import error, spaces, utils
 from gym.utils import seeding
-from snake import Env, SnakeState, INIT_TAIL_SIZE
+from snake import Env, BitboardEnv, SnakeState, INIT_TAIL_SIZE, GRID_CHANNELS, reward_map
+from snake_render import env_tiles, TILE_TAIL, ROTATIONS
 import random
 import time
 import cv2
@@ -24,19 +25,36 @@ action_map = {
     3: 'right'
 }
 
-reward_map = {
-    SnakeState.OK: -0.001,
-    SnakeState.ATE: 1,
-    SnakeState.DED: -1,
-    SnakeState.WON: 1
-}
-
-
 class SnakeEnv(gym.Env):
     metadata = {'render.modes': ['human', 'rgb_array']}
-    def __init__(self, gs=10, main_gs=10, num_fruits=1, action_map=None):
+    def __init__(self, gs=10, main_gs=10, num_fruits=1, action_map=None, bitboard=False,
+                 detect_loops=False, loop_state=None, obs_mode='image', scale=8, image_size=None,
+                 layout='hwc', frame_stack=1, recorder=None):
         super(SnakeEnv, self).__init__()
-        self.env = Env(gs, main_gs=main_gs, num_fruits=num_fruits)
+        # obs_mode 'image' is the rendered board, 'grid' the symbolic
+        # (C, gs, gs) uint8 planes of Env.to_grid and 'tiles' the
+        # (tiles, rotations) of the board for EnvManager(batch_render=True)
+        assert obs_mode in ['image', 'grid', 'tiles'], f"Unknown obs_mode {obs_mode}"
+        self.obs_mode = obs_mode
+        # image and grid observations are uint8 in layout 'hwc' or 'chw',
+        # scaling to [0, 1] is left to the model. With frame_stack > 1 the
+        # last frames are stacked on the channel axis and returned as a view
+        # into a ring buffer, so copy them if they are needed past the next
+        # step or reset
+        assert layout in ['hwc', 'chw'], f"Unknown layout {layout}"
+        self.layout = layout
+        self.frame_stack = frame_stack
+        self._ring = None
+        # recorder.EpisodeRecorder, recorded episodes are handed over as
+        # Env.to_bytes states when it has a decode, otherwise as frames
+        self.recorder = recorder
+        # bitboard only applies to grids up to 8x8
+        env_cls = BitboardEnv if bitboard and gs <= 8 else Env
+        # observations are drawn at scale pixels per cell, or straight at
+        # image_size x image_size when that is given
+        self.env = env_cls(gs, main_gs=main_gs, num_fruits=num_fruits,
+                           detect_loops=detect_loops, loop_state=loop_state,
+                           scale=scale, image_size=image_size)
         self.viewer = None
         self.action_map = {
             0: 'up',
@@ -48,9 +66,21 @@ class SnakeEnv(gym.Env):
             self.action_map = action_map
 
         self.action_space = spaces.Discrete(len(self.action_map.keys()))
-        self.observation_space = spaces.Box(
-            low=0, high=255, shape=(self.env.gs, self.env.gs, 3),
-            dtype=np.uint8)
+        if obs_mode == 'tiles':
+            # flat tile ids and rotation ids, one per cell, see env_tiles
+            cells = (self.env.gs * self.env.gs,)
+            self.observation_space = spaces.Tuple((
+                spaces.Box(low=0, high=TILE_TAIL, shape=cells, dtype=np.uint8),
+                spaces.Box(low=0, high=len(ROTATIONS) - 1, shape=cells, dtype=np.uint8),
+            ))
+        else:
+            if obs_mode == 'grid':
+                channels, size = GRID_CHANNELS, self.env.gs
+            else:
+                channels, size = 1, self.env.to_image(copy=False).shape[0]
+            channels *= frame_stack
+            shape = (channels, size, size) if layout == 'chw' else (size, size, channels)
+            self.observation_space = spaces.Box(low=0, high=255, shape=shape, dtype=np.uint8)
         self.idx = 0
         self.total_score = 0
         self.vis = False
@@ -62,10 +92,58 @@ class SnakeEnv(gym.Env):
 
         is_done = (enum in [SnakeState.DED, SnakeState.WON])
         info_dict = {}
+        if self.env.looped:
+            info_dict['loop'] = True
         if is_done:
-            info_dict['score'] = len(self.env.snake.tail) - INIT_TAIL_SIZE
-
-        return np.expand_dims(self.env.to_image().astype('float32'), -1), rew, is_done, info_dict
+            info_dict['score'] = self.env.snake.tail_len - INIT_TAIL_SIZE
+        if self.recorder is not None:
+            self._record(is_done)
+
+        return self._obs(), rew, is_done, info_dict
+
+    def _record(self, done=False):
+        rec = self.recorder
+        if rec.recording:
+            rec.add(self.env.to_bytes(rng=False) if rec.decode else self.env.to_image(copy=False))
+            if done:
+                rec.end_episode()
+
+    def _frame(self, copy=True):
+        if self.obs_mode == 'grid':
+            frame = self.env.to_grid()
+            return frame if self.layout == 'chw' else frame.transpose(1, 2, 0)
+        frame = self.env.to_image(copy=copy)
+        return frame[None] if self.layout == 'chw' else frame[..., None]
+
+    def _obs(self, reset=False):
+        if self.obs_mode == 'tiles':
+            return env_tiles(self.env)
+        if self.frame_stack == 1:
+            return self._frame()
+        return self._push_frame(self._frame(copy=False), reset)
+
+    def _push_frame(self, frame, reset):
+        # every frame is written to slot q and q + k of 2k slots, so the last
+        # k frames oldest first are always the contiguous slots q+1 .. q+k
+        k = self.frame_stack
+        axis = 0 if self.layout == 'chw' else 2
+        c = frame.shape[axis]
+        if self._ring is None:
+            shape = list(frame.shape)
+            shape[axis] = 2 * k * c
+            self._ring = np.empty(shape, dtype=np.uint8)
+            reset = True
+        ring = self._ring if axis == 0 else np.moveaxis(self._ring, 2, 0)
+        frame = frame if axis == 0 else np.moveaxis(frame, 2, 0)
+        if reset:
+            ring[:] = np.tile(frame, (2 * k, 1, 1))
+            q = self._ring_pos = k - 1
+        else:
+            q = self._ring_pos = (self._ring_pos + 1) % k
+            ring[q * c:(q + 1) * c] = frame
+            ring[(q + k) * c:(q + k + 1) * c] = frame
+        out = ring[(q + 1) * c:(q + k + 1) * c]
+        return out if axis == 0 else np.moveaxis(out, 0, 2)
 
     @property
     def dist(self):
@@ -77,7 +155,11 @@ class SnakeEnv(gym.Env):
         self.total_score = 0
         self.env.reset()
         self.last_dist = self.dist
-        return np.expand_dims(self.env.to_image().astype('float32'), -1)
+        if self.recorder is not None:
+            self.recorder.end_episode()
+            self.recorder.begin_episode()
+            self._record()
+        return self._obs(reset=True)
 
     def render(self, mode='human', close=False):
         im = self.env.to_image()
@@ -5,6 +5,9 @@ import wandb
 import argh
 import gym
 from snake_gym import *
+from symmetry import BoardSymmetry
+from recorder import EpisodeRecorder, snake_decoder
+from returns import discounted_returns
 import time
 
 import torch
@@ -13,13 +16,7 @@ import torch.nn.functional as F
 import torch.optim as optim
 
 def calc_qvals(rewards, gamma):
-    res = []
-    sum_r = 0.0
-    for r in reversed(rewards):
-        sum_r *= gamma
-        sum_r += r
-        res.append(sum_r)
-    return list(reversed(res))
+    return discounted_returns(np.asarray(rewards, dtype=np.float64), gamma=gamma).tolist()
 
 class NoisyLinear(nn.Linear):
     def __init__(self, in_features, out_features, sigma_init=0.017, bias=True):
@@ -44,6 +41,12 @@ class NoisyLinear(nn.Linear):
             bias = bias + self.sigma_bias * self.epsilon_bias.data
         return F.linear(input, self.weight + self.sigma_weight * self.epsilon_weight.data, bias)
 
+class CopyObservation(gym.ObservationWrapper):
+    # stacked observations are views into the env's ring buffer, the
+    # experience source keeps them past the next step
+    def observation(self, obs):
+        return obs if self.env.unwrapped.frame_stack == 1 else obs.copy()
+
 def unpack_batch(batch):
     states, actions, rewards, dones, last_states = [], [], [], [], []
     for exp in batch:
@@ -114,8 +117,10 @@ class Net(nn.Module):
         ]
 
 
-def calc_loss(batch, net, tgt_net, gamma, device="cpu"):
+def calc_loss(batch, net, tgt_net, gamma, device="cpu", symmetry=None):
     states, actions, rewards, dones, next_states = unpack_batch(batch)
+    if symmetry is not None:
+        states, actions, next_states = symmetry(states, actions, next_states)
 
     states_v = torch.tensor(states).to(device)
     next_states_v = torch.tensor(next_states).to(device)
@@ -134,7 +139,7 @@ def calc_loss(batch, net, tgt_net, gamma, device="cpu"):
 
 def run_test(net, env, max_steps=200, visualize=False):
     idx = 0
-    state = torch.Tensor(env.reset()._frames)
+    state = torch.as_tensor(env.reset())[None]
     action = torch.argmax(net(state))
     total_reward = 0
     done = False
@@ -143,7 +148,7 @@ def run_test(net, env, max_steps=200, visualize=False):
             env.render()
             time.sleep(0.02)
         state, reward, done, _ = env.step(action.item())
-        state = torch.Tensor(state._frames)
+        state = torch.as_tensor(state)[None]
         action = torch.argmax(net(state))
         total_reward += reward
         if done:
@@ -155,7 +160,7 @@ def run_test(net, env, max_steps=200, visualize=False):
     return i, total_reward, done
 
 
-def main(run_name, shape=10, winsize=4, num_max_test=1000, randseed=None, human_mode_sleep=0.02, device='cpu', gamma=0.99, tgt_net_sync=5000):
+def main(run_name, shape=10, winsize=4, num_max_test=1000, randseed=None, human_mode_sleep=0.02, device='cpu', gamma=0.99, tgt_net_sync=5000, augment=False, obs_mode='image', record_dir=None, main_gs=10):
 
     INPUT_SHAPE = (shape, shape)
     WINDOW_LENGTH = winsize
@@ -169,19 +174,37 @@ def main(run_name, shape=10, winsize=4, num_max_test=1000, randseed=None, human_
     except Exception:
         print(f"failed to intify seed of {randseed}, making it None")
         randseed = None
-    env = gym.make('snakenv-v0', gs=shape, seed=randseed, human_mode_sleep=human_mode_sleep)
-    env = ptan.common.wrappers.ImageToPyTorch(env)
-    env = ptan.common.wrappers.FrameStack(env, winsize)
-
-    test_env = gym.make('snakenv-v0', gs=shape, seed=randseed, human_mode_sleep=human_mode_sleep)
-    test_env = ptan.common.wrappers.ImageToPyTorch(test_env)
-    test_env = ptan.common.wrappers.FrameStack(test_env, winsize)
+    # observations come channels first straight from the env, the grid
+    # direction planes would need remapping under board symmetries so it
+    # can't be augmented
+    assert not (augment and obs_mode == 'grid'), "augment only works on image observations"
+    env = CopyObservation(gym.make('snakenv-v0', gs=shape, main_gs=main_gs, seed=randseed, human_mode_sleep=human_mode_sleep,
+                                   obs_mode=obs_mode, layout='chw', frame_stack=winsize))
+
+    test_env = gym.make('snakenv-v0', gs=shape, main_gs=main_gs, seed=randseed, human_mode_sleep=human_mode_sleep,
+                        obs_mode=obs_mode, layout='chw', frame_stack=winsize)
+    # record_dir keeps a video of every test episode, encoded off the training loop
+    # and decoded on a board set up like the test env's
+    recorder = None
+    if record_dir:
+        game = test_env.unwrapped.env
+        recorder = EpisodeRecorder(record_dir, decode=snake_decoder(game.gs, game.main_gs, game.scale))
+        test_env.unwrapped.recorder = recorder
 
     input_shape = (WINDOW_LENGTH,) + INPUT_SHAPE
 
-    net = Net(shape, env.action_space.n, channels=winsize).to(device)
+    channels = winsize * (GRID_CHANNELS if obs_mode == 'grid' else 1)
+    net = Net(shape, env.action_space.n, channels=channels).to(device)
     tgt_net = ptan.agent.TargetNet(net)
     batch_size = 32
+    symmetry = None
+    if augment:
+        # transformed frames are only frames the env draws itself when the
+        # board sits in the middle of the canvas
+        game = env.unwrapped.env
+        assert 2 * game.subgrid_loc.x == game.main_gs - game.gs, \
+            f"augment needs the board centred, main_gs {main_gs} puts the {shape} board at {game.subgrid_loc}"
+        symmetry = BoardSymmetry(env.observation_space.shape[-2:], env.unwrapped.action_map)
 
     wandb.init(project='snake-rl-ptan', name=run_name, config={
         'lr': lr,
@@ -191,8 +214,11 @@ def main(run_name, shape=10, winsize=4, num_max_test=1000, randseed=None, human_
         'gamma': gamma,
         'tgt_net_sync': tgt_net_sync,
         'shape': shape,
+        'main_gs': main_gs,
         'winsize': winsize,
         'batch_size': batch_size,
+        'augment': augment,
+        'obs_mode': obs_mode,
     })
 
     wandb.watch(net)
@@ -221,7 +247,7 @@ def main(run_name, shape=10, winsize=4, num_max_test=1000, randseed=None, human_
         optimizer.zero_grad()
         batch = buffer.sample(batch_size)
         loss_v = calc_loss(
-            batch, net, tgt_net.target_model, gamma, device=device)
+            batch, net, tgt_net.target_model, gamma, device=device, symmetry=symmetry)
 
         loss_v.backward()
         optimizer.step()
@@ -253,7 +279,7 @@ def main(run_name, shape=10, winsize=4, num_max_test=1000, randseed=None, human_
                 torch.save(net.state_dict, os.path.join(run_name, f"{tidx}.pth"))
 
 
-def main_reinforce(run_name, shape=4, winsize=1, num_max_test=1000, randseed=None, human_mode_sleep=0.02, device='cpu', gamma=0.99):
+def main_reinforce(run_name, shape=4, winsize=1, num_max_test=1000, randseed=None, human_mode_sleep=0.02, device='cpu', gamma=0.99, obs_mode='image'):
 
     INPUT_SHAPE = (shape, shape)
     WINDOW_LENGTH = winsize
@@ -267,17 +293,16 @@ def main_reinforce(run_name, shape=4, winsize=1, num_max_test=1000, randseed=Non
         print(f"failed to intify seed of {randseed}, making it None")
         randseed = None
 
-    env = gym.make('snakenv-v0', gs=shape, seed=randseed, human_mode_sleep=human_mode_sleep)
-    env = ptan.common.wrappers.ImageToPyTorch(env)
-    env = ptan.common.wrappers.FrameStack(env, winsize)
+    env = CopyObservation(gym.make('snakenv-v0', gs=shape, seed=randseed, human_mode_sleep=human_mode_sleep,
+                                   obs_mode=obs_mode, layout='chw', frame_stack=winsize))
 
-    test_env = gym.make('snakenv-v0', gs=shape, seed=randseed, human_mode_sleep=human_mode_sleep)
-    test_env = ptan.common.wrappers.ImageToPyTorch(test_env)
-    test_env = ptan.common.wrappers.FrameStack(test_env, winsize)
+    test_env = gym.make('snakenv-v0', gs=shape, seed=randseed, human_mode_sleep=human_mode_sleep, obs_mode=obs_mode,
+                        layout='chw', frame_stack=winsize)
 
     input_shape = (WINDOW_LENGTH,) + INPUT_SHAPE
 
-    net = Net(shape, env.action_space.n, channels=winsize).to(device)
+    channels = winsize * (GRID_CHANNELS if obs_mode == 'grid' else 1)
+    net = Net(shape, env.action_space.n, channels=channels).to(device)
 
     max_batch_episodes = 100
 
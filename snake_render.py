@@ -0,0 +1,112 @@
+from functools import lru_cache
+import numpy as np
+from snake import scaled_sprites, _dir_angles, _turn_angles
+
+# a board is described per cell by a tile id and a rotation id, the rotation
+# ids index ROTATIONS (degrees, as used by _rotate_image)
+TILE_EMPTY = 0
+TILE_FRUIT = 1
+TILE_HEAD = 2
+TILE_BODY = 3
+TILE_TURN = 4
+TILE_TAIL = 5
+tile_sprites = (None, 'fruit', 'head', 'body', 'turn', 'tail')
+
+ROTATIONS = (0, 90, 180, -90)
+_rotation_ids = {0: 0, 90: 1, 180: 2, -180: 2, -90: 3}
+
+# rotation ids for a direction index and for a turn (d1 left, d2 entered),
+# -1 where Env.to_image draws nothing
+DIR_ROTATIONS = np.array([_rotation_ids[a] for a in _dir_angles], dtype=np.uint8)
+TURN_ROTATIONS = np.array([[-1 if a is None else _rotation_ids[a] for a in row] for row in _turn_angles],
+                          dtype=np.int8)
+
+
+@lru_cache(maxsize=None)
+def sprite_atlas(scale=8):
+    """[tile, rotation, scale, scale] uint8, every sprite in every rotation"""
+    atlas = np.full((len(tile_sprites), len(ROTATIONS), scale, scale), 64, dtype=np.uint8)
+    scaled = scaled_sprites(scale, scale)
+    for t, name in enumerate(tile_sprites):
+        if name is None:
+            continue
+        for r, angle in enumerate(ROTATIONS):
+            atlas[t, r] = scaled[name][angle]
+    return atlas
+
+
+class TileRenderer:
+    """
+    Turns [N, gs, gs] tile and rotation id arrays into the [N, H, W] uint8
+    frames Env.to_image would draw. Every sprite row is handled as a single
+    scale-byte word, so the whole batch is one gather from the sprite atlas
+    and one strided copy into the canvas.
+    """
+
+    def __init__(self, gs, main_gs=None, subgrid_loc=None, scale=8):
+        self.gs = gs
+        self.main_gs = gs if main_gs is None else main_gs
+        self.scale = scale
+        self.word = {1: np.uint8, 2: np.uint16, 4: np.uint32, 8: np.uint64}.get(scale, np.dtype((np.void, scale)))
+        atlas = sprite_atlas(scale)
+        # [tile * rotations + rotation, sprite row] words
+        self.rows = np.ascontiguousarray(atlas).view(self.word).reshape(-1, scale)
+        self.num_rotations = atlas.shape[1]
+        self.loc = (0, 0) if subgrid_loc is None else (subgrid_loc.y, subgrid_loc.x)
+        self.shape = (self.main_gs * scale, self.main_gs * scale)
+
+    def render(self, tiles, rotations, out=None):
+        """out, if given, must be a C contiguous [N, H, W] uint8 array"""
+        tiles = np.asarray(tiles).reshape(-1, self.gs, self.gs)
+        rotations = np.asarray(rotations).reshape(tiles.shape)
+        n, gs, s = tiles.shape[0], self.gs, self.scale
+        if out is None:
+            out = np.zeros((n,) + self.shape, dtype=np.uint8)
+        # [N, gs, gs, s] sprite rows, written out as [N, gs, s, gs] words
+        cells = self.rows[tiles.astype(np.intp) * self.num_rotations + rotations]
+        y, x = self.loc
+        m = self.main_gs
+        board = out.view(self.word).reshape(n, m, s, m)[:, y:y + gs, :, x:x + gs]
+        board[:] = cells.transpose(0, 1, 3, 2)
+        return out
+
+    @classmethod
+    def for_env(cls, env):
+        """renderer matching the canvas of a snake.Env"""
+        if env.image_size is not None:
+            raise ValueError("TileRenderer needs an env rendering at a fixed scale, not an image_size")
+        return cls(env.gs, env.main_gs, env.subgrid_loc, env.scale)
+
+
+def env_tiles(env, tiles=None, rotations=None):
+    """
+    tile and rotation ids of a snake.Env board as flat [gs*gs] uint8 arrays,
+    cells are drawn in the same order as Env.to_image
+    """
+    a = env.gs * env.gs
+    if tiles is None:
+        tiles = np.zeros(a, dtype=np.uint8)
+        rotations = np.zeros(a, dtype=np.uint8)
+    else:
+        tiles[:] = TILE_EMPTY
+        rotations[:] = 0
+
+    for f in env.fruit_cells:
+        tiles[f] = TILE_FRUIT
+    snake = env.snake
+    if snake.head_cell >= 0:
+        tiles[snake.head_cell] = TILE_HEAD
+        rotations[snake.head_cell] = DIR_ROTATIONS[snake.dir_idx]
+
+    n = snake.tail_len
+    for k in range(n):
+        curr, d1 = snake.tail_cell(k), snake.tail_dir(k)
+        if k == n - 1:
+            tiles[curr], rotations[curr] = TILE_TAIL, DIR_ROTATIONS[d1]
+            break
+        d2 = snake.tail_dir(k + 1)
+        if d1 == d2:
+            tiles[curr], rotations[curr] = TILE_BODY, DIR_ROTATIONS[d2]
+        elif TURN_ROTATIONS[d1, d2] >= 0:
+            tiles[curr], rotations[curr] = TILE_TURN, TURN_ROTATIONS[d1, d2]
+    return tiles, rotations
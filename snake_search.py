@@ -0,0 +1,131 @@
+import time
+import numpy as np
+import argh
+from random import getstate, setstate
+from snake import Env, SnakeState, INIT_TAIL_SIZE, reward_map
+
+default_action_map = {
+    0: 'up',
+    1: 'down',
+    2: 'left',
+    3: 'right'
+}
+
+
+class LookaheadAgent:
+    """
+    Depth limited search over snake.Env futures. The tree is grown breadth
+    first from clones of the env until the node or time budget runs out, then
+    every leaf of the deepest finished level is scored with one value_fn call.
+    Each root action gets the best discounted return + gamma^depth * value
+    found underneath it. Fruit spawns are sampled once per node and the
+    global random state is put back after every search.
+
+    value_fn takes a list of Env leaves and returns one value per leaf, None
+    scores every leaf as 0 and makes this a pure reward lookahead.
+    """
+
+    def __init__(self, value_fn=None, action_map=None, gamma=0.99, max_nodes=512, max_ms=None, max_depth=16):
+        self.value_fn = value_fn
+        self.action_map = default_action_map if action_map is None else action_map
+        self.gamma = gamma
+        self.max_nodes = max_nodes
+        self.max_ms = max_ms
+        self.max_depth = max_depth
+        self.last_depth = 0
+        self.last_nodes = 0
+
+    def _over_budget(self, nodes, start):
+        if self.max_nodes is not None and nodes > self.max_nodes:
+            return True
+        return self.max_ms is not None and (time.perf_counter() - start) * 1000 > self.max_ms
+
+    def _expand(self, frontier, best, nodes, start, discount, budget=True):
+        # frontier items are (root action, env, return so far), returns the
+        # next level or None if the budget ran out part way through
+        actions = list(self.action_map.items())
+        nxt = []
+        for root, env, ret in frontier:
+            for i, (a, direction) in enumerate(actions):
+                nodes += 1
+                if budget and self._over_budget(nodes, start):
+                    return None, nodes
+                # the last child can take over its parent's env
+                child = env if i == len(actions) - 1 else env.clone()
+                enum = child.update(direction)
+                child_ret = ret + discount * reward_map[enum]
+                # children of the root start their own subtree
+                child_root = a if root is None else root
+                if enum in [SnakeState.DED, SnakeState.WON]:
+                    best[child_root] = max(best[child_root], child_ret)
+                else:
+                    nxt.append((child_root, child, child_ret))
+        return nxt, nodes
+
+    def search(self, env):
+        """returns {action: score} for every action in action_map"""
+        start = time.perf_counter()
+        rng = getstate()
+
+        frontier = [(None, env.clone(), 0.0)]
+        nodes = 0
+        depth = 0
+        done_best = {a: -np.inf for a in self.action_map}
+        while depth < self.max_depth and frontier:
+            best = dict(done_best)
+            # the first level is always searched so every action gets a score
+            nxt, nodes = self._expand(frontier, best, nodes, start, self.gamma ** depth, budget=depth > 0)
+            if nxt is None:
+                break
+            frontier, done_best = nxt, best
+            depth += 1
+
+        scores = dict(done_best)
+        if frontier and depth > 0:
+            if self.value_fn is None:
+                values = np.zeros(len(frontier))
+            else:
+                values = self.value_fn([f[1] for f in frontier])
+            bootstrap = self.gamma ** depth
+            for (root, _, ret), v in zip(frontier, values):
+                scores[root] = max(scores[root], ret + bootstrap * float(v))
+
+        setstate(rng)
+        self.last_depth = depth
+        self.last_nodes = nodes
+        return scores
+
+    def act(self, env):
+        scores = self.search(env)
+        return max(scores, key=scores.get)
+
+
+def ppo_value_fn(model, device='cpu'):
+    """value_fn for LookaheadAgent built on the value head of a VisualAgentPPO"""
+    import torch
+
+    def value_fn(envs):
+        obs = np.stack([e.to_image() for e in envs])[:, None].astype('float32')
+        hxs = torch.zeros((len(envs), getattr(model, '_recurrent', 0)))
+        with torch.no_grad():
+            _, value, _ = model(torch.from_numpy(obs).to(device), hxs.to(device))
+        return value.view(-1).cpu().numpy()
+
+    return value_fn
+
+
+def main(gs=10, main_gs=12, episodes=10, max_nodes=256, max_ms=0.0, max_steps=2000):
+    agent = LookaheadAgent(max_nodes=max_nodes, max_ms=max_ms or None)
+    for ep in range(episodes):
+        env = Env(gs, main_gs=main_gs, num_fruits=1)
+        env.reset()
+        for step in range(max_steps):
+            enum = env.update(agent.action_map[agent.act(env)])
+            if enum in [SnakeState.DED, SnakeState.WON]:
+                break
+        print(f"episode {ep}: {enum.name} score {env.snake.tail_len - INIT_TAIL_SIZE} "
+              f"after {step + 1} steps, last search depth {agent.last_depth}")
+
+
+if __name__ == '__main__':
+    argh.dispatch_command(main)
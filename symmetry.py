@@ -0,0 +1,139 @@
+import numpy as np
+from snake import action_dir_order
+from snake_batched import DIR_DX, DIR_DY
+
+default_action_map = {
+    0: 'up',
+    1: 'down',
+    2: 'left',
+    3: 'right'
+}
+
+
+def _transform(a, t):
+    # the 8 symmetries of a square: t % 4 quarter turns, then a mirror for t >= 4
+    a = np.rot90(a, t % 4)
+    return a[:, ::-1] if t >= 4 else a
+
+
+def _transform_dir(d, t):
+    grid = np.zeros((3, 3), dtype=np.int64)
+    grid[1 + DIR_DY[d], 1 + DIR_DX[d]] = 1
+    y, x = np.argwhere(_transform(grid, t) == 1)[0]
+    return next(i for i in range(4) if DIR_DX[i] == x - 1 and DIR_DY[i] == y - 1)
+
+
+def _is_torch(x):
+    return type(x).__module__.split('.')[0] == 'torch'
+
+
+def _torch_index(t, device):
+    import torch
+    return torch.as_tensor(t, dtype=torch.long, device=device)
+
+
+class BoardSymmetry:
+    """
+    Random dihedral symmetry per sample for batches of snake frames, with the
+    actions remapped through action_map so (obs, action) pairs stay valid.
+    Images are [N, C, H, W] or [N, H, W] (channels_last=False) or
+    [N, H, W, C] (channels_last=True), numpy or torch. A batch is transformed
+    with a single gather.
+
+    The sprites are symmetric about their own axis, so a transformed frame is
+    exactly the frame of the transformed board as long as the board sits in
+    the middle of the canvas (main_gs - gs even). Non square frames only use
+    the 4 symmetries that keep their shape.
+
+    transforms limits the symmetries used: indices 0-7 (t % 4 quarter turns,
+    then a mirror for t >= 4), or 'actions' for only those that map the
+    directions of action_map onto each other, for models without an action
+    per direction. Otherwise action_map must cover every direction its
+    actions can be mapped to.
+    """
+
+    def __init__(self, shape, action_map=None, channels_last=False, seed=None, transforms=None):
+        self.h, self.w = shape
+        self.channels_last = channels_last
+        self.rng = np.random.default_rng(seed)
+        square = np.arange(8) if self.h == self.w else np.array([0, 2, 4, 6])
+
+        action_map = default_action_map if action_map is None else action_map
+        actions = sorted(action_map.keys())
+        lookup = {action_map[a]: a for a in actions}
+
+        def mapped(a, t):
+            direction = action_map[a]
+            if direction:
+                direction = action_dir_order[_transform_dir(action_dir_order.index(direction), t)]
+            return direction
+
+        if transforms is None:
+            transforms = square
+        elif isinstance(transforms, str):
+            if transforms != 'actions':
+                raise ValueError(f"unknown transforms {transforms!r}")
+            transforms = [t for t in square if all(mapped(a, t) in lookup for a in actions)]
+        elif not set(transforms) <= set(square):
+            raise ValueError(f"transforms {transforms} don't all keep the {self.h}x{self.w} shape")
+        self.transforms = np.array(sorted(transforms), dtype=np.int64)
+
+        # perms[t] gathers the flat pixels of a frame into their place under t
+        flat = np.arange(self.h * self.w).reshape(self.h, self.w)
+        self.perms = np.zeros((8, self.h * self.w), dtype=np.int64)
+        self.action_table = np.zeros((8, len(actions)), dtype=np.int64)
+        for t in self.transforms:
+            self.perms[t] = _transform(flat, t).ravel()
+            for a in actions:
+                direction = mapped(a, t)
+                if direction not in lookup:
+                    raise ValueError(f"action_map has no action for {direction}, it must cover every direction its actions can be mapped to (or use transforms='actions')")
+                self.action_table[t, a] = lookup[direction]
+        self._torch_tables = {}
+
+    def sample(self, n):
+        return self.rng.choice(self.transforms, n)
+
+    def _tables(self, device):
+        import torch
+        if device not in self._torch_tables:
+            self._torch_tables[device] = (torch.as_tensor(self.perms, device=device),
+                                          torch.as_tensor(self.action_table, device=device))
+        return self._torch_tables[device]
+
+    def images(self, x, t):
+        n = x.shape[0]
+        hw = self.h * self.w
+        if self.channels_last:
+            flat = x.reshape(n, hw, -1)
+            axis = 1
+        else:
+            flat = x.reshape(n, -1, hw)
+            axis = 2
+
+        if _is_torch(x):
+            perms, _ = self._tables(x.device)
+            idx = perms[_torch_index(t, x.device)]
+            idx = idx.unsqueeze(-1) if self.channels_last else idx.unsqueeze(1)
+            return flat.gather(axis, idx.expand(*flat.shape)).view(x.shape)
+
+        idx = self.perms[t]
+        idx = idx[:, :, None] if self.channels_last else idx[:, None, :]
+        return np.take_along_axis(flat, idx, axis).reshape(x.shape)
+
+    def actions(self, a, t):
+        if _is_torch(a):
+            _, table = self._tables(a.device)
+            tt = _torch_index(t, a.device).view(-1, *[1] * (a.dim() - 1))
+            return table[tt, a.long()].to(a.dtype)
+        a = np.asarray(a)
+        tt = np.asarray(t).reshape(-1, *[1] * (a.ndim - 1))
+        return self.action_table[tt, a.astype(np.int64)].astype(a.dtype)
+
+    def __call__(self, obs, actions, *more_obs):
+        """
+        transform obs and every frame batch in more_obs (e.g. next
+        observations) with the same random symmetry per sample
+        """
+        t = self.sample(obs.shape[0])
+        return (self.images(obs, t), self.actions(actions, t)) + tuple(self.images(o, t) for o in more_obs)